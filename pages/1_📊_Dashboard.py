@@ -3,7 +3,8 @@ import pandas as pd
 import time
 import pytz # Importante para fuso horário
 from datetime import datetime
-from services.conexao_sheets import carregar_dados, atualizar_status_devolucao
+from services.conexao_sheets import carregar_dados, atualizar_status_devolucao, idade_snapshot, mostrar_falhas_escrita
+from services.prazos import classificar_prazos
 
 # ==============================================================================
 # 0. CONFIGURAÇÕES GLOBAIS & FUSO HORÁRIO
@@ -274,6 +275,9 @@ with st.sidebar:
 # ==============================================================================
 # 4. PREPARAÇÃO DE DADOS E KPIs
 # ==============================================================================
+# Movimentos do Kanban gravam em segundo plano: se algum falhou, avisa aqui
+mostrar_falhas_escrita()
+
 df = carregar_dados("REGISTRO_DEVOLUCOES")
 
 # Variáveis padrão
@@ -290,6 +294,10 @@ if not df.empty:
     # Processamento de Datas
     if 'DATA_CRIACAO' in df.columns:
         df['DATA_OBJ'] = pd.to_datetime(df['DATA_CRIACAO'], dayfirst=True, errors='coerce')
+        # Dias em aberto e rótulo de tempo de todos os processos numa passada só
+        prazos = classificar_prazos(df['DATA_OBJ'], hoje=agora_br.date())
+        df['DIAS_ABERTO'] = prazos['DIAS'].fillna(0).astype(int)
+        df['TEMPO_ABERTO'] = prazos['TEMPO'].where(prazos['DIAS'].notna(), "Hoje")
     
     # KPIs Básicos
     if 'STATUS' in df.columns:
@@ -297,10 +305,9 @@ if not df.empty:
         total_concluido = len(df[df['STATUS'] == 'CONCLUÍDO'])
         
         # Atraso (>7 dias)
-        if 'DATA_OBJ' in df.columns:
-            hoje_date = agora_br.date()
-            # Garante que a conta de dias funcione mesmo com NaT
-            mask_vencidos = (df['STATUS'] != 'CONCLUÍDO') & (df['DATA_OBJ'].apply(lambda x: (hoje_date - x.date()).days if pd.notnull(x) else 0) > 7)
+        if 'DIAS_ABERTO' in df.columns:
+            # NaT já entra como 0 dias
+            mask_vencidos = (df['STATUS'] != 'CONCLUÍDO') & (df['DIAS_ABERTO'] > 7)
             total_atrasados = len(df[mask_vencidos])
 
     if 'STATUS_FISCAL' in df.columns:
@@ -345,6 +352,9 @@ st.markdown(f"""
 
 # --- KPIs ---
 st.markdown("#### 📊 Métricas Chave")
+idade_dados = idade_snapshot("REGISTRO_DEVOLUCOES")
+if idade_dados is not None:
+    st.caption(f"🔄 Dados atualizados há {int(idade_dados)}s")
 k1, k2, k3, k4, k5 = st.columns(5)
 k1.metric("📦 Fila (Aberto)", total_aberto, delta_color="off")
 k2.metric("⚖️ Pend. Fiscal", pendencia_fiscal, delta="Atenção", delta_color="inverse")
@@ -411,17 +421,9 @@ if not df.empty and 'STATUS' in df.columns:
                 info_transporte = f"{veic} • {mot}" if (veic and mot) else mot if mot else "Sem motorista"
                 
                 # Cálculo de Tempo (Fuso Correto)
-                dias_aberto = 0
-                str_tempo = "Hoje"
-                if 'DATA_OBJ' in df.columns and not pd.isna(row['DATA_OBJ']):
-                     # Converte para data simples para comparar dias
-                     data_proc = row['DATA_OBJ'].date()
-                     hoje_date = agora_br.date()
-                     dias_aberto = (hoje_date - data_proc).days
-                     
-                     if dias_aberto == 0: str_tempo = "Hoje"
-                     elif dias_aberto == 1: str_tempo = "Ontem"
-                     else: str_tempo = f"há {dias_aberto}d"
+                # (já calculado para o DataFrame inteiro em classificar_prazos)
+                dias_aberto = row.get('DIAS_ABERTO', 0)
+                str_tempo = row.get('TEMPO_ABERTO', "Hoje")
                 
                 icon_time = "🔥" if dias_aberto > 7 else "🕒"
 
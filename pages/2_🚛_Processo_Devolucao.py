@@ -4,8 +4,10 @@ import base64
 import uuid
 import re 
 from datetime import datetime
-from services.conexao_sheets import carregar_dados, salvar_novo_processo, salvar_itens_lote
+from concurrent.futures import TimeoutError as FuturesTimeout
+from services.conexao_sheets import preaquecer_abas, criar_processo_completo, buscar_linha_por_nf, buscar_motivo_por_nf
 from services.upload_service import upload_bytes_cloudinary
+from services.prazos import classificar_prazos
 from pathlib import Path
 
 # Proteção de acesso
@@ -116,18 +118,19 @@ COL_OC_DATA_INI = "Data do problema"
 COL_OC_DATA_FIM = "Data do encerramento"
 COL_OC_OCORRENCIA = "Ocorrência"
 
+# Texto gravado na coluna PRAZO (mantém o formato que já existe na planilha)
+TEXTO_PRAZO_PLANILHA = {
+    "FRESCO": "FRESCO (<3 dias)",
+    "ATENÇÃO": "ATENÇÃO (<5 dias)",
+    "PRAZO 10": "DENTRO DO PRAZO DE 10",
+    "PRAZO 20": "DENTRO DO PRAZO DE 20",
+}
+
 def calcular_prazo_alerta(data_emissao_str):
-    try:
-        if not data_emissao_str or str(data_emissao_str).strip() == "": return "SEM DATA", "grey"
-        dt_emissao = pd.to_datetime(data_emissao_str, dayfirst=True).date()
-        hoje = datetime.now().date()
-        dias_corridos = (hoje - dt_emissao).days
-        if dias_corridos < 3: return f"FRESCO (<3 dias)", "#00B17C"
-        elif dias_corridos < 5: return f"ATENÇÃO (<5 dias)", "#5173C2"
-        elif dias_corridos < 10: return f"DENTRO DO PRAZO DE 10", "#EC9E55"
-        elif dias_corridos < 20: return f"DENTRO DO PRAZO DE 20", "#E9EB7B"
-        else: return f"ESTOUROU 20 DIAS ({dias_corridos} dias)", "#DB6464"
-    except: return "DATA INVÁLIDA", "grey"
+    prazo = classificar_prazos(pd.Series([data_emissao_str], dtype=object)).iloc[0]
+    if prazo["FAIXA"] == "ESTOUROU":
+        return f"ESTOUROU 20 DIAS ({prazo['DIAS']} dias)", prazo["COR"]
+    return TEXTO_PRAZO_PLANILHA.get(prazo["FAIXA"], prazo["FAIXA"]), prazo["COR"]
 
 # --- MEMÓRIA TEMPORÁRIA ---
 if 'lista_itens_temp' not in st.session_state: st.session_state['lista_itens_temp'] = []
@@ -174,38 +177,35 @@ if btn_buscar and nf_busca:
     st.session_state['aba_ativa'] = "1. Ocorrência" 
     
     # 2. Busca
-    df_reg = carregar_dados("REGISTRO_DEVOLUCOES")
     ja_existe = False
     dados_existentes = {} 
     
-    if not df_reg.empty and "NF" in df_reg.columns:
-        df_reg["NF_STR"] = df_reg["NF"].astype(str).str.replace(r'\.0$', '', regex=True).str.strip()
-        busca_limpa = str(nf_busca).strip()
-        filtro_reg = df_reg[df_reg["NF_STR"] == busca_limpa]
-        if not filtro_reg.empty:
-            ja_existe = True
-            dados_existentes = filtro_reg.iloc[0].to_dict()
-            st.warning(f"⚠️ Processo já registrado! ID: {dados_existentes.get('ID_PROCESSO')}")
-            st.session_state['status_busca'] = "existente"
-            
-            st.session_state['dados_encontrados'] = {
-                "NF": dados_existentes.get("NF", ""),
-                "CTE": dados_existentes.get("CTE", ""),
-                "DATA_EMISSAO": dados_existentes.get("DATA_EMISSAO", ""),
-                "OC": dados_existentes.get("OC", ""),
-                "LOCAL": dados_existentes.get("LOCAL", ""),
-                "LOCAL_DESTINO": dados_existentes.get("LOCAL_DESTINO", ""), # <--- Recupera Destino
-                "ORDEM_DE_CARGA": dados_existentes.get("ORDEM_DE_CARGA","") or dados_existentes.get("ORDEM_DE_CARGA",""),
-                "MOTIVO_COMPLETO": dados_existentes.get("MOTIVO", ""),
-                "RESPONSAVEL": dados_existentes.get("RESPONSAVEL", ""),
-                "VEICULO": dados_existentes.get("VEICULO", ""),
-                "TIPO_VEICULO": dados_existentes.get("TIPO_VEICULO", ""),
-                "MOTORISTA": dados_existentes.get("MOTORISTA", ""),
-                "DATA_INICIO": dados_existentes.get("DATA_INICIO", ""),
-                "DATA_FIM": dados_existentes.get("DATA_FIM", ""),
-                "TIPO_CARGA": dados_existentes.get("TIPO_CARGA", "DIRETA"),
-                "DATA_DEVOLUCAO_CTE": dados_existentes.get("DATA_DEVOLUCAO_CTE", "")
-            }
+    # Consulta direta no índice de NF do snapshot (sem varrer a aba)
+    reg_encontrado = buscar_linha_por_nf("REGISTRO_DEVOLUCOES", "NF", nf_busca)
+    if reg_encontrado:
+        ja_existe = True
+        dados_existentes = reg_encontrado
+        st.warning(f"⚠️ Processo já registrado! ID: {dados_existentes.get('ID_PROCESSO')}")
+        st.session_state['status_busca'] = "existente"
+        
+        st.session_state['dados_encontrados'] = {
+            "NF": dados_existentes.get("NF", ""),
+            "CTE": dados_existentes.get("CTE", ""),
+            "DATA_EMISSAO": dados_existentes.get("DATA_EMISSAO", ""),
+            "OC": dados_existentes.get("OC", ""),
+            "LOCAL": dados_existentes.get("LOCAL", ""),
+            "LOCAL_DESTINO": dados_existentes.get("LOCAL_DESTINO", ""), # <--- Recupera Destino
+            "ORDEM_DE_CARGA": dados_existentes.get("ORDEM_DE_CARGA","") or dados_existentes.get("ORDEM_DE_CARGA",""),
+            "MOTIVO_COMPLETO": dados_existentes.get("MOTIVO", ""),
+            "RESPONSAVEL": dados_existentes.get("RESPONSAVEL", ""),
+            "VEICULO": dados_existentes.get("VEICULO", ""),
+            "TIPO_VEICULO": dados_existentes.get("TIPO_VEICULO", ""),
+            "MOTORISTA": dados_existentes.get("MOTORISTA", ""),
+            "DATA_INICIO": dados_existentes.get("DATA_INICIO", ""),
+            "DATA_FIM": dados_existentes.get("DATA_FIM", ""),
+            "TIPO_CARGA": dados_existentes.get("TIPO_CARGA", "DIRETA"),
+            "DATA_DEVOLUCAO_CTE": dados_existentes.get("DATA_DEVOLUCAO_CTE", "")
+        }
 
     # 3. Inicializa CACHES (Blindagem de Dados)
     def get_val(chave, alt=""): return str(dados_existentes.get(chave, "") or alt) if ja_existe else ""
@@ -242,38 +242,15 @@ if btn_buscar and nf_busca:
     # 4. Busca Bases Externas (Se Novo)
     if not ja_existe:
         with st.spinner("Consultando bases de dados..."):
-            df_x3 = carregar_dados("DATABASE_X3")
-            df_oc = carregar_dados("DATABASE_OC")
-            if not df_x3.empty: df_x3.columns = df_x3.columns.str.strip()
-            if not df_oc.empty: df_oc.columns = df_oc.columns.str.strip()
-
-            res_x3, res_oc = {}, {}
-            busca_limpa = str(nf_busca).strip()
-
-            if COL_X3_NF in df_x3.columns:
-                df_x3["_NF_BUSCA"] = df_x3[COL_X3_NF].astype(str).str.replace(r'\.0$', '', regex=True).str.strip()
-                f_x3 = df_x3[df_x3["_NF_BUSCA"] == busca_limpa]
-                if not f_x3.empty: res_x3 = f_x3.iloc[0].to_dict()
-                else:
-                    f_x3_part = df_x3[df_x3["_NF_BUSCA"].str.contains(busca_limpa, na=False)]
-                    if not f_x3_part.empty: res_x3 = f_x3_part.iloc[0].to_dict()
-
-            if COL_OC_MOTIVO in df_oc.columns:
-                f_oc = df_oc[df_oc[COL_OC_MOTIVO].astype(str).str.contains(busca_limpa, na=False)]
-                if not f_oc.empty: res_oc = f_oc.iloc[0].to_dict()
+            # Garante as duas bases no snapshot (download em paralelo se faltar)
+            preaquecer_abas(["DATABASE_X3", "DATABASE_OC"])
+
+            # Índices por snapshot: NF exata (ou trecho) no X3 e NF citada no texto de motivos da OC
+            res_x3 = buscar_linha_por_nf("DATABASE_X3", COL_X3_NF, nf_busca, parcial=True)
+            res_oc, motivo_limpo = buscar_motivo_por_nf("DATABASE_OC", COL_OC_MOTIVO, nf_busca)
 
             if res_x3 or res_oc:
                 st.success("✅ Dados encontrados!")
-                motivo_bruto = res_oc.get(COL_OC_MOTIVO, "")
-                motivo_limpo = motivo_bruto 
-                if motivo_bruto:
-                    linhas = str(motivo_bruto).split('\n')
-                    for linha in linhas:
-                        if nf_busca in linha:
-                            partes = linha.split('-', 1) 
-                            motivo_limpo = partes[1].strip() if len(partes) > 1 else linha
-                            break
-
                 st.session_state['cache_motivo'] = motivo_limpo 
                 
                 # Preenche Cache com dados encontrados
@@ -452,7 +429,7 @@ if dados:
                     link_nfd_doc = ""
                     arquivo_final = st.session_state.get('cache_nfd_arquivo')
                     if arquivo_final:
-                        bytes_do_arquivo = arquivo_final.read()
+                        bytes_do_arquivo = arquivo_final.getvalue()  # getvalue: se a gravação falhar, o próximo clique relê o arquivo
                         nome_arquivo = f"NFD_{dados.get('NF')}_{uuid.uuid4()}"
                         link_nfd_doc = upload_bytes_cloudinary(bytes_do_arquivo, nome_arquivo)
 
@@ -498,38 +475,49 @@ if dados:
                         "LINK_NFD": link_nfd_doc 
                     }
                     
-                    sucesso, id_gerado = salvar_novo_processo(pacote_salvar)
+                    itens_finais = []
+                    for item in st.session_state['lista_itens_temp']:
+                        
+                        try:
+                            qtd_limpa = float(str(item["QTD"]).replace("'", ""))
+                            qtd_raw = int(qtd_limpa) 
+                        except:
+                            qtd_raw = 0
+                        
+                        # 2. Valores: Converte para FLOAT puro
+                        try:
+                            val_limpo = str(item["VALOR"]).replace("'", "").replace("R$", "")
+                            val_unit_raw = float(item["VALOR"])
+                        except:
+                            val_unit_raw = 0.0
+                            
+                        # 3. Recálculo Matemático
+                        val_total_raw = round(qtd_raw * val_unit_raw, 2)
+
+                        itens_finais.append({
+                            "NUMERO_NFD": str(item["NFD"]), 
+                            "COD_ITEM": str(item["CODIGO"]), 
+                            "DESCRICAO": str(item["DESC"]),
+                            "QTD": qtd_raw,
+                            "VALOR_UNIT": val_unit_raw,
+                            "VALOR_TOTAL": val_total_raw
+                        })
+                    
+                    # Capa + itens num único envio: ou entram os dois, ou nenhum
+                    futuro, id_gerado = criar_processo_completo(pacote_salvar, itens_finais)
+                    
+                    # Criação é rara: espera a planilha confirmar antes de limpar o formulário
+                    sucesso = False
+                    if futuro:
+                        try:
+                            id_gerado = futuro.result(timeout=120)  # ID gravado (muda se houve colisão)
+                            sucesso = True
+                        except FuturesTimeout:
+                            st.error("❌ A planilha não confirmou a gravação a tempo. Confira na Gestão antes de salvar de novo.")
+                        except Exception as e:
+                            st.error(f"❌ Erro ao salvar o processo na planilha (nada foi gravado): {e}")
                     
                     if sucesso:
-                        itens_finais = []
-                        for item in st.session_state['lista_itens_temp']:
-                            
-                            try:
-                                qtd_limpa = float(str(item["QTD"]).replace("'", ""))
-                                qtd_raw = int(qtd_limpa) 
-                            except:
-                                qtd_raw = 0
-                            
-                            # 2. Valores: Converte para FLOAT puro
-                            try:
-                                val_limpo = str(item["VALOR"]).replace("'", "").replace("R$", "")
-                                val_unit_raw = float(item["VALOR"])
-                            except:
-                                val_unit_raw = 0.0
-                                
-                            # 3. Recálculo Matemático
-                            val_total_raw = round(qtd_raw * val_unit_raw, 2)
-
-                            itens_finais.append({
-                                "NUMERO_NFD": str(item["NFD"]), 
-                                "COD_ITEM": str(item["CODIGO"]), 
-                                "DESCRICAO": str(item["DESC"]),
-                                "QTD": qtd_raw,
-                                "VALOR_UNIT": val_unit_raw,
-                                "VALOR_TOTAL": val_total_raw
-                            })
-                        
-                        salvar_itens_lote(id_gerado, itens_finais)
                         st.success(f"Processo {id_gerado} Salvo com Documento!")
                         
                         # Limpa tudo
@@ -2,7 +2,7 @@ import streamlit as st
 import pandas as pd
 import uuid
 import time
-import re # Importante para limpar o texto da moeda
+from concurrent.futures import Future, TimeoutError as FuturesTimeout
 from datetime import datetime, date, timedelta
 from pathlib import Path
 
@@ -22,83 +22,12 @@ def card_html(label, value, border_class, sub_html=""):
     </div>
     """
 
-def converter_br_para_float(valor):
-    """
-    Transforma strings sujas ('R$ 1.000,50') em float puro (1000.50).
-    Evita a concatenação de texto.
-    """
-    if pd.isna(valor) or valor is None:
-        return 0.0
-    
-    s = str(valor).strip()
-    
-    # Se já é vazio, retorna 0
-    if s == "" or s.lower() == "nan" or s.lower() == "none":
-        return 0.0
-    
-    # Remove R$, espaços
-    s = re.sub(r'R\$', '', s)
-    s = re.sub(r'\s+', '', s)
-    
-    # Remove pontos de milhar (1.000 -> 1000)
-    s = re.sub(r'\.(?=\d{3})', '', s)
-    
-    # Troca vírgula decimal por ponto (50,00 -> 50.00)
-    s = s.replace(',', '.')
-    
-    try:
-        return float(s)
-    except ValueError:
-        # Se ainda falhar, tenta extrair apenas números e ponto
-        numeros = re.findall(r'[\d.]+', s)
-        if numeros:
-            try:
-                return float(numeros[0])
-            except:
-                return 0.0
-        return 0.0
-
-def formatar_moeda(valor):
-    """Transforma float em string bonita (R$ 1.000,00)"""
-    try:
-        # PRIMEIRO converte para float
-        val_float = converter_br_para_float(valor)
-        # DEPOIS formata
-        return f"R$ {val_float:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-    except:
-        return "R$ 0,00"
-
 def calcular_total_processo(id_proc):
     """
     Retorna o valor total somado (float) e a string formatada.
+    Lê da Series de totais calculada de uma vez para todos os processos.
     """
-    df_itens = carregar_itens_por_processo(id_proc)
-    if df_itens.empty:
-        return 0.0, "R$ 0,00"
-    
-    total = 0.0
-    
-    # Verifica qual coluna usar
-    if "VALOR_TOTAL" in df_itens.columns:
-        coluna_valor = "VALOR_TOTAL"
-    elif "TOTAL" in df_itens.columns:
-        coluna_valor = "TOTAL"
-    elif "VALOR" in df_itens.columns:
-        coluna_valor = "VALOR"
-    else:
-        # Tenta calcular QTD * VALOR_UNIT se disponível
-        if "QTD" in df_itens.columns and "VALOR_UNIT" in df_itens.columns:
-            df_itens["VALOR_CALCULADO"] = df_itens.apply(
-                lambda row: converter_br_para_float(row.get("QTD", 0)) * 
-                           converter_br_para_float(row.get("VALOR_UNIT", 0)), 
-                axis=1
-            )
-            coluna_valor = "VALOR_CALCULADO"
-        else:
-            return 0.0, "R$ 0,00"
-    
-    # Aplica conversão e soma
-    total = df_itens[coluna_valor].apply(converter_br_para_float).sum()
+    total = float(totais_por_processo().get(str(id_proc).strip(), 0.0))
     
     # Formata o resultado
     total_fmt = f"R$ {total:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
@@ -292,41 +221,21 @@ from services.conexao_sheets import (
     salvar_mensagem, 
     excluir_processo_completo,
     carregar_itens_por_processo, 
+    totais_por_processo,
+    buscar_processos,
     atualizar_status_devolucao,
-    atualizar_tratativa_completa
+    atualizar_tratativa_completa,
+    mostrar_falhas_escrita
 )
-from services.upload_service import upload_bytes_cloudinary
+from services.upload_service import upload_bytes_cloudinary, upload_varios, aguardar_links
+from services.numeros_br import formatar_moeda_br
+from services.prazos import classificar_prazos
 
 
 st.title("Gestão de Tratativas")
 
-def calcular_prazo_alerta(data_inicio_str, status_atual, data_fim_str=None):
-    try:
-        if not data_inicio_str or str(data_inicio_str).strip() in ["", "None", "NaT"]:
-            return "SEM DATA INÍCIO", "grey"
-        
-        dt_inicio = pd.to_datetime(data_inicio_str, dayfirst=True, errors='coerce').date()
-        if pd.isna(dt_inicio): return "DATA INVÁLIDA", "grey"
-
-        if status_atual == "CONCLUÍDO":
-            if data_fim_str and str(data_fim_str).strip() not in ["", "None"]:
-                dt_fim = pd.to_datetime(data_fim_str, dayfirst=True, errors='coerce').date()
-            else:
-                dt_fim = datetime.now().date()
-            texto_extra = " (Finalizado)"
-        else:
-            dt_fim = datetime.now().date()
-            texto_extra = ""
-
-        dias_corridos = (dt_fim - dt_inicio).days
-        
-        if dias_corridos < 3: return f"FRESCO ({dias_corridos} dias){texto_extra}", "#00B17C"
-        elif dias_corridos < 5: return f"ATENÇÃO ({dias_corridos} dias){texto_extra}", "#5173C2"
-        elif dias_corridos < 10: return f"PRAZO 10 ({dias_corridos} dias){texto_extra}", "#EC9E55"
-        elif dias_corridos < 20: return f"PRAZO 20 ({dias_corridos} dias){texto_extra}", "#E9EB7B"
-        else: return f"ESTOUROU ({dias_corridos} dias){texto_extra}", "#FF4B4B"
-    except:
-        return f"ERRO CÁLCULO", "grey"
+# Kanban e chat gravam em segundo plano: se algo falhou desde o último clique, avisa aqui
+mostrar_falhas_escrita()
 
 def renderizar_chat_visual(df_msgs):
     if df_msgs.empty:
@@ -389,9 +298,9 @@ def modal_detalhes_completo(id_proc, dados_row, usuario_atual):
         
         # Formata Visualmente para a Tabela
         if "VALOR_UNIT" in df_show.columns: 
-            df_show["VALOR_UNIT"] = df_show["VALOR_UNIT"].apply(formatar_moeda)
+            df_show["VALOR_UNIT"] = formatar_moeda_br(df_show["VALOR_UNIT"])
         if "VALOR_TOTAL" in df_show.columns: 
-            df_show["VALOR_TOTAL"] = df_show["VALOR_TOTAL"].apply(formatar_moeda)
+            df_show["VALOR_TOTAL"] = formatar_moeda_br(df_show["VALOR_TOTAL"])
         
         cols_show = [c for c in ["COD_ITEM", "DESCRICAO", "QTD", "VALOR_UNIT", "VALOR_TOTAL"] if c in df_show.columns]
         st.dataframe(df_show[cols_show], use_container_width=True, hide_index=True)
@@ -445,6 +354,16 @@ if not df_proc.empty:
         errors='coerce'
     )
 
+    # Prazo (SLA) de todos os processos de uma vez - fica fora do df_proc para não entrar na busca
+    def _coluna_texto(nome):
+        return df_proc[nome].fillna("").astype(str).str.strip() if nome in df_proc.columns else pd.Series("", index=df_proc.index)
+
+    data_dev_cte = _coluna_texto("DATA_DEVOLUCAO_CTE")
+    data_base = data_dev_cte.where(data_dev_cte != "", _coluna_texto("DATA_EMISSAO"))
+    concluido = df_proc["STATUS"].astype(str) == "CONCLUÍDO"
+    prazos_proc = classificar_prazos(data_base, datas_fim=_coluna_texto("DATA_FIM").where(concluido, ""))
+    prazos_proc["ROTULO"] = prazos_proc["ROTULO"].where(~concluido | prazos_proc["DIAS"].isna(), prazos_proc["ROTULO"] + " (Finalizado)")
+
 # --- FILTROS ---
 hoje = datetime.now().date()
 inicio_padrao = hoje - timedelta(days=30)
@@ -507,10 +426,9 @@ if not df_filtered.empty:
     
     # Busca Textual Global
     if filtro_nf:
-        termo = filtro_nf.upper().strip()
-        # Verifica se o termo existe em QUALQUER coluna da linha
-        mask = df_view.astype(str).apply(lambda x: x.str.upper().str.contains(termo, na=False)).any(axis=1)
-        df_view = df_view[mask]
+        # Índice de busca do snapshot: devolve os IDs que têm o termo em QUALQUER coluna
+        ids_encontrados = buscar_processos(filtro_nf)
+        df_view = df_view[df_view["ID_PROCESSO"].astype(str).str.strip().isin(ids_encontrados)]
         
 else:
     df_view = pd.DataFrame()
@@ -573,9 +491,9 @@ if tipo_visualizacao == "Lista":
                 st.markdown(f"**Itens do Processo** (Total: {valor_total_str})")
                 df_show = df_itens.copy()
                 if "VALOR_TOTAL" in df_show.columns: 
-                    df_show["VALOR_TOTAL"] = df_show["VALOR_TOTAL"].apply(formatar_moeda)
+                    df_show["VALOR_TOTAL"] = formatar_moeda_br(df_show["VALOR_TOTAL"])
                 if "VALOR_UNIT" in df_show.columns:
-                    df_show["VALOR_UNIT"] = df_show["VALOR_UNIT"].apply(formatar_moeda)
+                    df_show["VALOR_UNIT"] = formatar_moeda_br(df_show["VALOR_UNIT"])
                     
                 cols_show = [c for c in ["COD_ITEM", "DESCRICAO", "QTD", "VALOR_UNIT", "VALOR_TOTAL"] if c in df_show.columns]
                 st.dataframe(df_show[cols_show], use_container_width=True, hide_index=True)
@@ -615,9 +533,8 @@ if tipo_visualizacao == "Lista":
                     c_dados, c_anexo = st.columns([1, 1.5]) 
                     with c_dados:
                         dt_base = str(row.get('DATA_DEVOLUCAO_CTE', '') or row.get('DATA_EMISSAO', ''))
-                        st_atual = str(row.get('STATUS', 'ABERTO'))
-                        dt_final = str(row.get('DATA_FIM', '')) 
-                        msg_prazo, cor_prazo = calcular_prazo_alerta(dt_base, st_atual, dt_final)
+                        msg_prazo = prazos_proc.at[index, "ROTULO"]
+                        cor_prazo = prazos_proc.at[index, "COR"]
                         
                         st.markdown(f"""<div style="margin-top: 5px; margin-bottom: 15px; padding: 8px; border-radius: 4px; background-color: {cor_prazo}20; border-left: 4px solid {cor_prazo}; color: {cor_prazo}; font-weight: bold; font-size: 13px;">⏱️ {msg_prazo} <br><span style="font-size:10px; color:#888">Início: {dt_base}</span></div>""", unsafe_allow_html=True)
 
@@ -667,29 +584,44 @@ if tipo_visualizacao == "Lista":
 
                     if st.form_submit_button("💾 Salvar Tudo", type="primary"):
                         with st.spinner("Processando..."):
-                            link_final_cte = ""
+                            # CTE e COB sobem ao mesmo tempo: espera só o mais lento
+                            anexos = {}
+                            if arqcte_status:
+                                anexos["CTE"] = (arqcte_status.getvalue(), f"CTE_{id_proc}_{arqcte_status.name}")
+                            if arq_status:
+                                anexos["COB"] = (arq_status.getvalue(), f"COB_{id_proc}_{arq_status.name}")
+                            links = aguardar_links(upload_varios(anexos))
+
+                            link_final_cte = links.get("CTE", "")
                             if arqcte_status:
-                                link_final_cte = upload_bytes_cloudinary(arqcte_status.getvalue(), f"CTE_{id_proc}_{arqcte_status.name}")
                                 salvar_mensagem(id_proc, st.session_state.get('usuario', 'System'), f"📎 Novo CTE anexado.", link_final_cte)
                             
-                            link_final_cob = ""
+                            link_final_cob = links.get("COB", "")
                             if arq_status:
-                                link_final_cob = upload_bytes_cloudinary(arq_status.getvalue(), f"COB_{id_proc}_{arq_status.name}")
                                 salvar_mensagem(id_proc, st.session_state.get('usuario', 'System'), f"📎 Nova evidência anexada.", link_final_cob)
                             
-                            sucesso = atualizar_tratativa_completa(
+                            resultado = atualizar_tratativa_completa(
                                 id_proc, n_log, n_fisc, n_cod_cob, 
                                 link_final_cob, link_final_cte, n_cod_cte,
                                 n_veiculo, n_motorista, n_loc_atual, n_loc_dest,
                                 n_oc, n_data_dev, n_data_cob, val_ordem_carga
                             )
 
+                            # Vai para a fila de escrita: espera a planilha confirmar antes do "sucesso"
+                            sucesso = False
+                            try:
+                                sucesso = resultado.result(timeout=60) if isinstance(resultado, Future) else bool(resultado)
+                                if not sucesso:
+                                    st.error("❌ Erro ao salvar na planilha.")
+                            except FuturesTimeout:
+                                st.error("❌ A planilha não confirmou a gravação a tempo. Confira o processo antes de salvar de novo.")
+                            except Exception as e:
+                                st.error(f"❌ Erro ao salvar na planilha: {e}")
+
                             if sucesso:
                                 st.success("✅ Atualizado com sucesso!")
                                 time.sleep(1)
                                 st.rerun()
-                            else:
-                                st.error("❌ Erro ao salvar na planilha.")
             
             # --- CHAT (DIREITA) ---
             with col_r:
@@ -1,8 +1,11 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
+import numpy as np
 from datetime import datetime
-from services.conexao_sheets import carregar_dados
+from services.conexao_sheets import carregar_varias_abas, preaquecer_abas, versao_aba
+from services.numeros_br import converter_numeros_br
+from services.indice_busca import montar_indice_tokens, buscar_tokens
 
 # ==============================================================================
 # 0. PROTEÇÃO DE ACESSO
@@ -138,19 +141,10 @@ with st.sidebar:
 # ==============================================================================
 # 3. FUNÇÕES E CARGA
 # ==============================================================================
-def converter_float(valor):
-    if pd.isna(valor) or valor == "": return 0.0
-    if isinstance(valor, (float, int)): return float(valor)
-    v = str(valor).replace("R$", "").replace(" ", "").strip()
-    if "," in v[-3:]: v = v.replace(".", "").replace(",", ".")
-    elif "." in v[-3:]: v = v.replace(",", "")
-    try: return float(v)
-    except: return 0.0
-
-@st.cache_data(ttl=60)
 def carregar_dados_consolidados():
-    df_processos = carregar_dados("REGISTRO_DEVOLUCOES")
-    df_itens = carregar_dados("REGISTRO_ITENS")
+    abas = carregar_varias_abas(["REGISTRO_DEVOLUCOES", "REGISTRO_ITENS"])
+    df_processos = abas["REGISTRO_DEVOLUCOES"]
+    df_itens = abas["REGISTRO_ITENS"]
 
     if df_processos.empty or df_itens.empty: return pd.DataFrame()
 
@@ -164,8 +158,8 @@ def carregar_dados_consolidados():
     df_itens[col_id_item] = df_itens[col_id_item].astype(str).str.strip()
 
     col_val = "VALOR_TOTAL" if "VALOR_TOTAL" in df_itens.columns else "VALOR"
-    df_itens["VALOR_TOTAL_FLOAT"] = df_itens[col_val].apply(converter_float) if col_val in df_itens.columns else 0.0
-    df_itens["QTD_FLOAT"] = df_itens["QTD"].apply(converter_float) if "QTD" in df_itens.columns else 0.0
+    df_itens["VALOR_TOTAL_FLOAT"] = converter_numeros_br(df_itens[col_val])[0] if col_val in df_itens.columns else 0.0
+    df_itens["QTD_FLOAT"] = converter_numeros_br(df_itens["QTD"])[0] if "QTD" in df_itens.columns else 0.0
 
     cols_capa = [col_id_proc, "LOCAL_DESTINO", "NF", "VEICULO", "DATA_EMISSAO", "STATUS", "OC", "MOTORISTA", "STATUS_FISCAL"]
     cols_existentes = [c for c in cols_capa if c in df_processos.columns]
@@ -180,6 +174,21 @@ def carregar_dados_consolidados():
     
     return df_full
 
+@st.cache_resource(max_entries=4)
+def estoque_consolidado(versao_processos, versao_itens):
+    """
+    Consolidado + índice de busca dele, juntos no mesmo objeto (compartilhado entre
+    sessões: somente leitura). As versões só entram na chave do cache; como elas
+    mudam a cada escrita, não precisa limpar o cache na mão.
+    """
+    return {"df": carregar_dados_consolidados(), "indice": None}
+
+def indice_busca_estoque(estoque):
+    # Montado sobre o mesmo df que a página filtra: as posições sempre batem com as linhas
+    if estoque["indice"] is None:
+        estoque["indice"] = montar_indice_tokens(estoque["df"])
+    return estoque["indice"]
+
 @st.dialog("🕵️ Rastro Detalhado do Item", width="large")
 def modal_rastro(item):
     st.markdown(f"### {item.get('DESCRICAO', 'Item')}")
@@ -208,7 +217,10 @@ def modal_rastro(item):
 st.title("Controle de Estoque por Destino")
 
 try:
-    df = carregar_dados_consolidados()
+    # Baixa antes de ler as versões: no cold start a chave não fica (None, None)
+    preaquecer_abas(["REGISTRO_DEVOLUCOES", "REGISTRO_ITENS"])
+    estoque = estoque_consolidado(versao_aba("REGISTRO_DEVOLUCOES"), versao_aba("REGISTRO_ITENS"))
+    df = estoque["df"]
 except Exception as e:
     st.error(f"Erro ao carregar: {e}")
     st.stop()
@@ -241,29 +253,27 @@ with st.expander("🔍 Filtros & Visualização", expanded=True):
 # ==============================================================================
 # 6. ENGINE DE FILTRAGEM (CRUZAMENTO)
 # ==============================================================================
-df_final = df.copy()
+# Cada filtro vira uma máscara sobre as posições do df consolidado; cruza tudo no fim
+mask_final = np.ones(len(df), dtype=bool)
 
 # A. Aplica Data
 if isinstance(datas_sel, tuple) and len(datas_sel) == 2:
     start, end = datas_sel
-    if "DT_OBJ" in df_final.columns:
-        df_final = df_final[(df_final["DT_OBJ"].dt.date >= start) & (df_final["DT_OBJ"].dt.date <= end)]
+    if "DT_OBJ" in df.columns:
+        datas = df["DT_OBJ"].dt.date
+        mask_final &= ((datas >= start) & (datas <= end)).to_numpy()
 
 # B. Aplica Local
 if destinos_sel:
-    df_final = df_final[df_final["LOCAL_DESTINO"].isin(destinos_sel)]
+    mask_final &= df["LOCAL_DESTINO"].isin(destinos_sel).to_numpy()
 
-# C. Aplica Busca
+# C. Aplica Busca (índice de tokens do consolidado, montado uma vez por versão)
 if search_term:
-    t = search_term.lower()
-    mask = (
-        df_final["DESCRICAO"].astype(str).str.lower().str.contains(t) |
-        df_final["NF"].astype(str).str.lower().str.contains(t) |
-        df_final["COD_ITEM"].astype(str).str.lower().str.contains(t) |
-        df_final["ID_PROCESSO"].astype(str).str.lower().str.contains(t) |
-        df_final["OC"].astype(str).str.lower().str.contains(t)
-    )
-    df_final = df_final[mask]
+    mask_busca = np.zeros(len(df), dtype=bool)
+    mask_busca[buscar_tokens(indice_busca_estoque(estoque), search_term)] = True
+    mask_final &= mask_busca
+
+df_final = df[mask_final]
 
 # ==============================================================================
 # 7. KPIs (CALCULADOS SOBRE OS DADOS CRUZADOS/FILTRADOS)
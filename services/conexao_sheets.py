@@ -1,12 +1,26 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import requests
 import gspread
 from google.oauth2.service_account import Credentials
+import os
+import re
+import json
 import uuid
+import time
+import hashlib
+import queue
+import threading
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor, Future
 from datetime import datetime, date, timedelta
 from zoneinfo import ZoneInfo
-from io import StringIO
+from io import BytesIO
+from pathlib import Path
+from services.numeros_br import converter_numeros_br
+from services.indice_busca import montar_indice_geral, buscar_no_indice_geral
+from services.cota_api import executar_com_cota, ClienteHTTPComCota
 
 # ==============================================================================
 # CONFIGURAÇÕES GERAIS
@@ -32,6 +46,40 @@ TAB_IDS = {
     "DATABASE_OC": "989316476"
 }
 
+# Limite de downloads simultâneos no carregar_varias_abas (não estourar o Google)
+MAX_DOWNLOADS_PARALELOS = 4
+
+# Intervalo (segundos) entre atualizações em segundo plano de cada aba.
+# Bases externas grandes mudam pouco; registros operacionais mudam o tempo todo.
+INTERVALO_REFRESH = {
+    "USUARIOS": 300,
+    "REGISTRO_ITENS": 30,
+    "REGISTRO_MENSAGENS": 15,
+    "REGISTRO_DEVOLUCOES": 30,
+    "DATABASE_X3": 600,
+    "DATABASE_OC": 600
+}
+INTERVALO_REFRESH_PADRAO = 30
+
+# De quanto em quanto tempo a thread do refresher acorda para checar as abas
+INTERVALO_CICLO_REFRESHER = 5
+
+# Onde ficam as cópias em disco dos snapshots (warm start após restart / nova réplica)
+PASTA_SNAPSHOTS = Path(".cache") / "snapshots"
+
+# Só estas abas vão para disco: as grandes, que demoram a baixar no warm start.
+# USUARIOS fica de fora de propósito (tem a coluna PASSWORD com os hashes das senhas).
+ABAS_PERSISTIDAS_DISCO = {"REGISTRO_ITENS", "REGISTRO_MENSAGENS", "REGISTRO_DEVOLUCOES", "DATABASE_X3", "DATABASE_OC"}
+
+# Por quanto tempo (segundos) os handles de planilha/aba de escrita são reaproveitados
+VALIDADE_HANDLES = 600
+
+# Quanto tempo (segundos) o worker de escrita espera juntando comandos num lote
+JANELA_COALESCENCIA = 0.25
+
+# Máximo de linhas por request nas escritas em lote do salvar_dataframe
+TAMANHO_LOTE_ESCRITA = 500
+
 # Escopos (ESCRITA)
 SCOPE = [
     "https://www.googleapis.com/auth/spreadsheets",
@@ -39,66 +87,623 @@ SCOPE = [
 ]
 
 # ==============================================================================
-# 1. LEITURA RÁPIDA (CQRS - Query) - Via Requests
+# 1. LEITURA RÁPIDA (CQRS - Query) - Snapshots em memória + Refresher
 # ==============================================================================
-@st.cache_data(ttl=30, show_spinner=False)
+# Cada aba fica em memória como um "snapshot" (último DataFrame bom + hora do
+# download). Uma thread em segundo plano baixa o CSV de novo no intervalo de
+# cada aba e troca o snapshot inteiro sob lock. As páginas recebem sempre o
+# último snapshot na hora: ninguém espera o Google no meio do rerun.
+# Só bloqueia quando a aba nunca foi baixada ou foi invalidada por uma escrita.
+#
+# Detecção de mudança: guardamos o hash dos bytes do CSV junto do snapshot.
+# Se o download vier idêntico, reaproveita o DataFrame já parseado (sem read_csv)
+# e a "versao" não muda, então os caches derivados (chaveados pela versão)
+# também não recalculam nada.
+#
+# Persistência: todo snapshot novo das abas em ABAS_PERSISTIDAS_DISCO também vai
+# para disco (o CSV cru + JSON com a hora do download e o hash). No start do processo eles são carregados na hora e o
+# refresher atualiza em segundo plano. Se o Google falhar, o último snapshot
+# (de memória ou de disco) continua sendo servido.
+#
+# Write-through: depois de um append/update na planilha, o comando aplica a
+# mesma mudança direto no snapshot (patch), sem baixar a aba de novo. Cada
+# patch ganha um número de "versao_local" e fica pendente até o CSV export
+# refleti-lo; no próximo download o refresher reaplica os patches que o Google
+# ainda não mostra (export atrasado) e descarta os já refletidos ou vencidos.
+
+# {aba: {"df": DataFrame, "ts": epoch do download, "invalido": bool, "hash": sha256 do CSV,
+#        "versao": int, "versao_local": int, "patches": [patch pendente, ...],
+#        "derivados": {nome: índice/cálculo feito uma vez sobre este df}}}
+_SNAPSHOTS = {}
+_LOCK_SNAPSHOTS = threading.Lock()
+_LOCKS_DOWNLOAD = {aba: threading.Lock() for aba in TAB_IDS}  # 1 download por aba por vez
+_REFRESHER = {"thread": None, "disco_carregado": False}
+_METRICAS_HASH = {"hits": 0, "misses": 0}
+
+# Depois disso sem aparecer no CSV export, o patch é descartado (a planilha manda)
+PRAZO_PATCH_PENDENTE = 120
+
+def _baixar_csv(nome_da_aba):
+    """Baixa o CSV export da aba e devolve os bytes crus. Levanta exceção em caso de erro (sem st.*)."""
+    sheet_id = st.secrets["ID_PLANILHA"]
+    gid = TAB_IDS[nome_da_aba]
+    url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=csv&gid={gid}"
+
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+    }
+
+    # Passa pelo limite de cota: espera a vez e tenta de novo em 429/5xx
+    response = executar_com_cota("csv_export", lambda: requests.get(url, headers=headers, timeout=10))
+
+    # Se der erro 400 ou 500, vai cair no except de quem chamou
+    response.raise_for_status()
+    return response.content
+
+def _ler_csv(conteudo):
+    return pd.read_csv(BytesIO(conteudo), encoding='utf-8').fillna("")
+
+def _arquivos_snapshot(nome_da_aba):
+    return PASTA_SNAPSHOTS / f"{nome_da_aba}.csv", PASTA_SNAPSHOTS / f"{nome_da_aba}.json"
+
+def _salvar_snapshot_disco(nome_da_aba, snap, conteudo=None):
+    """
+    Grava o snapshot em disco (escrita em .tmp + rename, nunca deixa arquivo pela metade).
+    Vai o CSV cru que veio do Google: no warm start ele passa pelo mesmo _ler_csv
+    e o DataFrame sai idêntico ao do caminho de rede. conteudo=None: só a hora muda.
+    Abas fora de ABAS_PERSISTIDAS_DISCO não são gravadas.
+    """
+    if nome_da_aba not in ABAS_PERSISTIDAS_DISCO:
+        return
+    try:
+        arq_dados, arq_meta = _arquivos_snapshot(nome_da_aba)
+        PASTA_SNAPSHOTS.mkdir(parents=True, exist_ok=True)
+
+        if conteudo is not None:
+            tmp = arq_dados.with_suffix(".csv.tmp")
+            tmp.write_bytes(conteudo)
+            os.replace(tmp, arq_dados)
+
+        tmp = arq_meta.with_suffix(".json.tmp")
+        tmp.write_text(json.dumps({"ts": snap["ts"], "hash": snap["hash"]}), encoding="utf-8")
+        os.replace(tmp, arq_meta)
+    except Exception as e:
+        print(f"Aviso: não foi possível salvar o snapshot de '{nome_da_aba}' em disco: {e}")
+
+def _carregar_snapshots_disco():
+    """Warm start: sobe para a memória os snapshots salvos em disco (o refresher atualiza depois)."""
+    for aba in TAB_IDS:
+        arq_dados, arq_meta = _arquivos_snapshot(aba)
+        if aba not in ABAS_PERSISTIDAS_DISCO:
+            # Não carrega e apaga o que uma versão anterior possa ter deixado (ex.: USUARIOS)
+            for arquivo in (arq_dados, arq_meta):
+                arquivo.unlink(missing_ok=True)
+            continue
+        if not (arq_dados.exists() and arq_meta.exists()):
+            continue
+        try:
+            meta = json.loads(arq_meta.read_text(encoding="utf-8"))
+            conteudo = arq_dados.read_bytes()
+            if hashlib.sha256(conteudo).hexdigest() != meta["hash"]:
+                raise ValueError("hash do CSV não confere com o JSON")
+            snap = {"df": _ler_csv(conteudo), "ts": meta["ts"], "invalido": False, "hash": meta["hash"],
+                    "versao": 1, "versao_local": 0, "patches": [], "derivados": {}}
+        except Exception as e:
+            print(f"Aviso: snapshot em disco de '{aba}' ilegível: {e}")
+            continue
+        with _LOCK_SNAPSHOTS:
+            _SNAPSHOTS.setdefault(aba, snap)
+
+def _publicar_snapshot(nome_da_aba, conteudo):
+    """
+    Troca o snapshot da aba de uma vez só (atomicamente).
+    Se o hash do CSV é o mesmo do snapshot atual, só renova a hora (sem parsear de novo).
+    """
+    hash_csv = hashlib.sha256(conteudo).hexdigest()
+    atual = _SNAPSHOTS.get(nome_da_aba)
+
+    # Parse fora do lock: X3/OC são grandes e as leituras não podem ficar esperando
+    df_planilha = _ler_csv(conteudo) if atual is None or atual["hash"] != hash_csv else None
+
+    with _LOCK_SNAPSHOTS:
+        atual = _SNAPSHOTS.get(nome_da_aba)  # Pode ter ganhado patch (ou descarte) enquanto parseávamos
+        # O hash decide de novo sob o lock: se descartar_patches zerou ele depois da
+        # conferência lá de cima, o df atual tem linhas que falharam e não pode ser republicado
+        mudou = atual is None or atual["hash"] != hash_csv
+        if mudou and df_planilha is None:
+            df_planilha = _ler_csv(conteudo)  # Raro (descarte no meio): parseia aqui mesmo
+
+        versao_local = atual["versao_local"] if atual is not None else 0
+
+        if not mudou:
+            # Planilha igual: o df atual (com os patches já aplicados) continua valendo
+            df, versao, patches = atual["df"], atual["versao"], atual["patches"]
+            derivados = atual["derivados"]  # Mesmo df: índices e cálculos continuam valendo
+            chave_metrica = "hits"
+        else:
+            patches = _reconciliar_patches(df_planilha, atual["patches"] if atual is not None else [])
+            df = df_planilha
+            for patch in patches:
+                df = _aplicar_patch(df, patch)
+            versao = (atual["versao"] + 1) if atual is not None else 1
+            derivados = {}
+            chave_metrica = "misses"
+
+        snap = {"df": df, "ts": time.time(), "invalido": False, "hash": hash_csv,
+                "versao": versao, "versao_local": versao_local, "patches": patches, "derivados": derivados}
+        _SNAPSHOTS[nome_da_aba] = snap
+        _METRICAS_HASH[chave_metrica] += 1
+
+    # Em disco vai só o que veio da planilha. CSV idêntico: só a hora muda, não regrava o CSV
+    _salvar_snapshot_disco(nome_da_aba, snap, conteudo=conteudo if mudou else None)
+    return snap
+
+def _atualizar_snapshot(nome_da_aba, esperar=True):
+    """
+    Baixa a aba e publica o novo snapshot. Com o lock da aba para não baixar em dobro.
+    esperar=False (refresher): se alguém já está baixando essa aba, só pula.
+    """
+    lock = _LOCKS_DOWNLOAD[nome_da_aba]
+    pedido_em = time.time()
+    if not lock.acquire(blocking=esperar):
+        return _SNAPSHOTS.get(nome_da_aba)
+    try:
+        # Se outra thread baixou enquanto esperávamos o lock, aproveita o download dela
+        snap = _SNAPSHOTS.get(nome_da_aba)
+        if snap is not None and not snap["invalido"] and snap["ts"] >= pedido_em:
+            return snap
+        return _publicar_snapshot(nome_da_aba, _baixar_csv(nome_da_aba))
+    finally:
+        lock.release()
+
+def _snapshot_precisa_refresh(nome_da_aba, agora):
+    snap = _SNAPSHOTS.get(nome_da_aba)
+    if snap is None or snap["invalido"]:
+        return True
+    intervalo = INTERVALO_REFRESH.get(nome_da_aba, INTERVALO_REFRESH_PADRAO)
+    return agora - snap["ts"] >= intervalo
+
+def _loop_refresher():
+    """Thread de fundo: mantém todas as abas do TAB_IDS atualizadas no seu próprio ritmo."""
+    while True:
+        for aba in TAB_IDS:
+            if not _snapshot_precisa_refresh(aba, time.time()):
+                continue
+            try:
+                _atualizar_snapshot(aba, esperar=False)
+            except Exception as e:
+                # Mantém o último snapshot bom; tenta de novo no próximo ciclo
+                print(f"Refresher: falha ao atualizar '{aba}': {e}")
+        time.sleep(INTERVALO_CICLO_REFRESHER)
+
+def _garantir_refresher():
+    """Sobe a thread do refresher uma única vez por processo (antes, carrega os snapshots do disco)."""
+    with _LOCK_SNAPSHOTS:
+        thread = _REFRESHER["thread"]
+        if thread is not None and thread.is_alive():
+            return
+        thread = threading.Thread(target=_loop_refresher, name="refresher-sheets", daemon=True)
+        _REFRESHER["thread"] = thread
+        carregar_disco = not _REFRESHER["disco_carregado"]
+        _REFRESHER["disco_carregado"] = True
+
+    if carregar_disco:
+        _carregar_snapshots_disco()
+    thread.start()
+
+def _validar_leitura(nome_da_aba):
+    """Checagens de configuração (COM DEBUG VISUAL). Retorna True se dá para ler a aba."""
+    if "ID_PLANILHA" not in st.secrets:
+        st.error("DEBUG: ID_PLANILHA não encontrado nos secrets!")
+        return False
+
+    # DEBUG: Verifica se achou o ID da aba
+    if nome_da_aba not in TAB_IDS:
+        st.error(f"DEBUG: Aba '{nome_da_aba}' não encontrada no TAB_IDS. IDs disponíveis: {list(TAB_IDS.keys())}")
+        return False
+    return True
+
+def _entregar_snapshot(nome_da_aba, snap, erro=None):
+    """Converte o snapshot em DataFrame para a página (cópia: as páginas alteram o df)."""
+    if snap is None:
+        st.error(f"DEBUG ERRO FATAL ({nome_da_aba}): {erro}")
+        return pd.DataFrame()
+
+    if erro is not None:
+        # Google fora do ar: serve o último snapshot bom em vez de tela vazia
+        print(f"Leitura de '{nome_da_aba}' falhou ({erro}); servindo snapshot anterior.")
+
+    # DEBUG: Verifica se o CSV veio vazio
+    if snap["df"].empty:
+        st.warning(f"DEBUG: A conexão funcionou, mas a aba '{nome_da_aba}' (GID {TAB_IDS[nome_da_aba]}) está vazia!")
+
+    return snap["df"].copy()
+
 def carregar_dados(nome_da_aba):
-    """Lê dados via CSV export (COM DEBUG VISUAL)"""
+    """
+    Lê a aba a partir do snapshot em memória (stale-while-revalidate).
+    Só baixa na hora se a aba ainda não tem snapshot ou foi invalidada por uma escrita.
+    """
+    if not _validar_leitura(nome_da_aba):
+        return pd.DataFrame()
+
+    snap, erro = _snapshot_atual(nome_da_aba)
+    return _entregar_snapshot(nome_da_aba, snap, erro=erro)
+
+def _snapshot_atual(nome_da_aba):
+    """
+    Snapshot pronto para leitura (sem cópia) e o erro do download, se houve.
+    Só baixa na hora se a aba ainda não tem snapshot ou foi invalidada.
+    """
+    _garantir_refresher()
+
+    snap = _SNAPSHOTS.get(nome_da_aba)
+    if snap is not None and not snap["invalido"]:
+        return snap, None
+
     try:
-        if "ID_PLANILHA" not in st.secrets:
-            st.error("DEBUG: ID_PLANILHA não encontrado nos secrets!")
-            return pd.DataFrame()
-            
-        sheet_id = st.secrets["ID_PLANILHA"]
-        
-        # DEBUG: Verifica se achou o ID da aba
-        if nome_da_aba not in TAB_IDS:
-            st.error(f"DEBUG: Aba '{nome_da_aba}' não encontrada no TAB_IDS. IDs disponíveis: {list(TAB_IDS.keys())}")
-            return pd.DataFrame()
+        return _atualizar_snapshot(nome_da_aba), None
+    except Exception as e:
+        return _SNAPSHOTS.get(nome_da_aba), e
 
-        gid = TAB_IDS[nome_da_aba]
-        
-        # Monta a URL
-        url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=csv&gid={gid}"
-        
-        # DEBUG: Mostra a URL que está tentando acessar (apague depois)
-        # st.write(f"Tentando baixar: {url}") 
-        
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-        }
-        
-        response = requests.get(url, headers=headers, timeout=10)
-        
-        # Se der erro 400 ou 500, vai cair no except
-        response.raise_for_status() 
-        response.encoding = 'utf-8'
-        
-        df = pd.read_csv(StringIO(response.text)).fillna("")
-        
-        # DEBUG: Verifica se o CSV veio vazio
-        if df.empty:
-            st.warning(f"DEBUG: A conexão funcionou, mas a aba '{nome_da_aba}' (GID {gid}) está vazia!")
-            
+def obter_derivado(nome_da_aba, nome, construtor):
+    """
+    Dado derivado do snapshot atual da aba (índice, totais, ...): construtor(df)
+    roda uma única vez por versão do snapshot e o resultado fica guardado nele.
+    O resultado é compartilhado entre sessões: trate como somente leitura.
+    """
+    if not _validar_leitura(nome_da_aba):
+        return construtor(pd.DataFrame())
+
+    snap, erro = _snapshot_atual(nome_da_aba)
+    if snap is None:
+        st.error(f"DEBUG ERRO FATAL ({nome_da_aba}): {erro}")
+        return construtor(pd.DataFrame())
+
+    derivados = snap["derivados"]
+    if nome not in derivados:
+        derivados[nome] = construtor(snap["df"])
+    return derivados[nome]
+
+def preaquecer_abas(nomes_abas, max_workers=MAX_DOWNLOADS_PARALELOS):
+    """
+    Garante snapshot das abas sem devolver (nem copiar) os DataFrames: as que não
+    têm snapshot (ou foram invalidadas) são baixadas em paralelo num pool limitado.
+    Retorna {nome_da_aba: erro} das que falharam.
+    """
+    abas = [aba for aba in dict.fromkeys(nomes_abas) if _validar_leitura(aba)]  # Remove repetidas mantendo a ordem
+    _garantir_refresher()
+
+    pendentes = [aba for aba in abas if _SNAPSHOTS.get(aba) is None or _SNAPSHOTS[aba]["invalido"]]
+    erros = {}
+    if pendentes:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(pendentes))) as pool:
+            futuros = {aba: pool.submit(_atualizar_snapshot, aba) for aba in pendentes}
+            for aba, futuro in futuros.items():
+                try:
+                    futuro.result()
+                except Exception as e:
+                    erros[aba] = e
+    return erros
+
+def carregar_varias_abas(nomes_abas, max_workers=MAX_DOWNLOADS_PARALELOS):
+    """
+    Lê várias abas de uma vez (downloads que faltam em paralelo, via preaquecer_abas).
+    Retorna {nome_da_aba: DataFrame}.
+    """
+    erros = preaquecer_abas(nomes_abas, max_workers)
+    abas = [aba for aba in dict.fromkeys(nomes_abas) if _validar_leitura(aba)]
+    resultado = {aba: _entregar_snapshot(aba, _SNAPSHOTS.get(aba), erro=erros.get(aba)) for aba in abas}
+    for aba in dict.fromkeys(nomes_abas):
+        resultado.setdefault(aba, pd.DataFrame())
+    return resultado
+
+def invalidar_snapshots(abas=None):
+    """Marca snapshots como inválidos (após escrita): a próxima leitura baixa de novo."""
+    with _LOCK_SNAPSHOTS:
+        for aba in (abas if abas is not None else list(_SNAPSHOTS)):
+            if aba in _SNAPSHOTS:
+                _SNAPSHOTS[aba]["invalido"] = True
+
+# --- PATCH DO SNAPSHOT (write-through) ---
+
+def _aplicar_patch(df, patch):
+    """Devolve um novo DataFrame com o patch aplicado (o df publicado nunca é alterado)."""
+    if patch["tipo"] == "append":
+        novas = pd.DataFrame(patch["linhas"]).reindex(columns=df.columns, fill_value="")
+        return pd.concat([df, novas], ignore_index=True)
+
+    # update: muda as células da(s) linha(s) cuja coluna-chave bate com o valor
+    if patch["chave"] not in df.columns:
         return df
-        
-    except Exception as e:
-        st.error(f"DEBUG ERRO FATAL ({nome_da_aba}): {e}")
+    df = df.copy()
+    mascara = df[patch["chave"]].astype(str).str.strip() == str(patch["valor_chave"])
+    for coluna, valor in patch["valores"].items():
+        if coluna not in df.columns:
+            continue
+        if not (pd.api.types.is_object_dtype(df[coluna]) or pd.api.types.is_string_dtype(df[coluna])):
+            df[coluna] = df[coluna].astype(object)  # Coluna numérica recebendo texto
+        df.loc[mascara, coluna] = valor
+    return df
+
+def _normalizar_celula(valor):
+    """Texto comparável de uma célula: o CSV devolve número como 7.0 e o patch guarda '7'."""
+    texto = str(valor).strip()
+    return texto[:-2] if texto.endswith(".0") else texto
+
+def _patch_refletido(df, patch):
+    """True se o CSV que veio da planilha já contém a mudança do patch."""
+    if patch["tipo"] == "append":
+        chave = patch["chave"]
+        if chave not in df.columns:
+            return False
+        presentes = set(df[chave].astype(str).str.strip())
+        return all(str(linha.get(chave, "")).strip() in presentes for linha in patch["linhas"])
+
+    if patch["chave"] not in df.columns:
+        return True  # Nada para reaplicar
+    linhas = df[df[patch["chave"]].astype(str).str.strip() == str(patch["valor_chave"])]
+    if linhas.empty:
+        return True  # Linha sumiu da planilha (excluída): o patch perdeu o sentido
+    return all(
+        coluna not in linhas.columns or (linhas[coluna].map(_normalizar_celula) == _normalizar_celula(valor)).all()
+        for coluna, valor in patch["valores"].items()
+    )
+
+def _reconciliar_patches(df_planilha, patches):
+    """Mantém só os patches recentes que o CSV export ainda não mostra."""
+    agora = time.time()
+    return [
+        p for p in patches
+        if agora - p["ts"] < PRAZO_PATCH_PENDENTE and not _patch_refletido(df_planilha, p)
+    ]
+
+def _registrar_patch(nome_da_aba, patch):
+    """Aplica o patch no snapshot da aba e guarda como pendente até a planilha confirmar."""
+    with _LOCK_SNAPSHOTS:
+        snap = _SNAPSHOTS.get(nome_da_aba)
+        if snap is None or snap["invalido"]:
+            return False  # A próxima leitura já vai baixar a aba inteira
+        patch = {**patch, "ts": time.time(), "versao_local": snap["versao_local"] + 1}
+        _SNAPSHOTS[nome_da_aba] = {
+            **snap,
+            "df": _aplicar_patch(snap["df"], patch),
+            "versao": snap["versao"] + 1,
+            "versao_local": patch["versao_local"],
+            "patches": snap["patches"] + [patch],
+            "derivados": {}
+        }
+    return True
+
+def descartar_patches(nome_da_aba):
+    """
+    A escrita não chegou na planilha: tira os patches pendentes da aba e força
+    baixar de novo (hash zerado para o CSV ser parseado mesmo se não mudou).
+    """
+    with _LOCK_SNAPSHOTS:
+        snap = _SNAPSHOTS.get(nome_da_aba)
+        if snap is not None:
+            _SNAPSHOTS[nome_da_aba] = {**snap, "patches": [], "hash": None, "invalido": True}
+
+def patch_append(nome_da_aba, linhas):
+    """
+    Acrescenta linhas no snapshot da aba (antes de o append ir para a fila de escrita).
+    linhas: dicts {coluna: valor} ou listas na ordem das colunas da aba.
+    A primeira coluna da aba é usada como chave para saber quando a planilha já tem a linha.
+    """
+    snap = _SNAPSHOTS.get(nome_da_aba)
+    if snap is None or snap["df"].columns.empty:
+        return False
+    colunas = list(snap["df"].columns)
+    linhas = [dict(zip(colunas, l)) if isinstance(l, (list, tuple)) else dict(l) for l in linhas]
+    return _registrar_patch(nome_da_aba, {"tipo": "append", "chave": colunas[0], "linhas": linhas})
+
+def patch_update(nome_da_aba, valor_chave, valores, chave="ID_PROCESSO"):
+    """Atualiza no snapshot as células {coluna: valor} da linha cuja `chave` == valor_chave."""
+    return _registrar_patch(nome_da_aba, {
+        "tipo": "update", "chave": chave, "valor_chave": str(valor_chave).strip(),
+        "valores": {coluna: str(valor) for coluna, valor in valores.items()}
+    })
+
+def versao_aba(nome_da_aba):
+    """
+    Versão do conteúdo da aba (muda só quando o CSV muda de verdade).
+    Use como argumento de funções @st.cache_data que derivam dados da aba.
+    """
+    snap = _SNAPSHOTS.get(nome_da_aba)
+    return snap["versao"] if snap is not None else None
+
+def metricas_cache():
+    """Contadores da detecção de mudança: hits (CSV idêntico, parse pulado) e misses (CSV novo)."""
+    with _LOCK_SNAPSHOTS:
+        return dict(_METRICAS_HASH)
+
+def idade_snapshot(nome_da_aba):
+    """Idade (segundos) do snapshot da aba, ou None se ainda não foi baixada."""
+    snap = _SNAPSHOTS.get(nome_da_aba)
+    if snap is None:
+        return None
+    return time.time() - snap["ts"]
+
+def idade_snapshots():
+    """Idade (segundos) de todos os snapshots: {aba: segundos ou None}. Para a UI mostrar o frescor."""
+    return {aba: idade_snapshot(aba) for aba in TAB_IDS}
+
+# --- ÍNDICE POR ID_PROCESSO ---
+# Itens e mensagens são consultados por processo várias vezes por rerun (uma por
+# expander na Gestão). O índice ID_PROCESSO -> posições das linhas é montado uma
+# vez por snapshot e cada consulta vira um fatiamento direto, sem varrer a aba.
+
+def _indexar_por_processo(df):
+    if df.empty or "ID_PROCESSO" not in df.columns:
+        return {"df": df, "posicoes": None}
+    chaves = df["ID_PROCESSO"].astype(str).str.strip()
+    return {"df": df, "posicoes": chaves.groupby(chaves, sort=False).indices}
+
+def _linhas_do_processo(nome_da_aba, id_processo):
+    indice = obter_derivado(nome_da_aba, "por_processo", _indexar_por_processo)
+    if indice["posicoes"] is None:
         return pd.DataFrame()
+    posicoes = indice["posicoes"].get(str(id_processo).strip(), [])
+    return indice["df"].iloc[posicoes].copy()
 
 def carregar_itens_por_processo(id_processo):
-    df = carregar_dados("REGISTRO_ITENS")
-    if not df.empty and "ID_PROCESSO" in df.columns:
-        df["ID_PROCESSO"] = df["ID_PROCESSO"].astype(str)
-        return df[df["ID_PROCESSO"] == str(id_processo)]
-    return pd.DataFrame()
+    return _linhas_do_processo("REGISTRO_ITENS", id_processo)
 
 def carregar_mensagens(id_processo):
-    df = carregar_dados("REGISTRO_MENSAGENS")
-    if not df.empty and "ID_PROCESSO" in df.columns:
-        df["ID_PROCESSO"] = df["ID_PROCESSO"].astype(str)
-        return df[df["ID_PROCESSO"] == str(id_processo)].sort_values("DATA_HORA")
-    return pd.DataFrame()
+    df = _linhas_do_processo("REGISTRO_MENSAGENS", id_processo)
+    if not df.empty and "DATA_HORA" in df.columns:
+        return df.sort_values("DATA_HORA")
+    return df
+
+# --- TOTAIS POR PROCESSO (VETORIZADO) ---
+
+def _calcular_totais(df_itens):
+    if df_itens.empty or "ID_PROCESSO" not in df_itens.columns:
+        return pd.Series(dtype=float)
+
+    for coluna in ["VALOR_TOTAL", "TOTAL", "VALOR"]:
+        if coluna in df_itens.columns:
+            valores, _ = converter_numeros_br(df_itens[coluna])
+            break
+    else:
+        # Sem coluna de total: calcula QTD * VALOR_UNIT se disponível
+        if "QTD" not in df_itens.columns or "VALOR_UNIT" not in df_itens.columns:
+            return pd.Series(dtype=float)
+        valores = converter_numeros_br(df_itens["QTD"])[0] * converter_numeros_br(df_itens["VALOR_UNIT"])[0]
+
+    chaves = df_itens["ID_PROCESSO"].astype(str).str.strip()
+    return valores.groupby(chaves, sort=False).sum()
+
+def totais_por_processo():
+    """
+    Valor total dos itens de todos os processos de uma vez: Series ID_PROCESSO -> float.
+    Um único parse de moeda + um groupby, guardado por snapshot do REGISTRO_ITENS.
+    """
+    return obter_derivado("REGISTRO_ITENS", "totais_por_processo", _calcular_totais)
+
+# --- BUSCA GERAL DA GESTÃO ---
+
+def buscar_processos(termo):
+    """
+    IDs dos processos (REGISTRO_DEVOLUCOES) com 'termo' em alguma coluna.
+    O índice de busca é montado uma vez por snapshot; a consulta não varre a aba.
+    """
+    indice = obter_derivado("REGISTRO_DEVOLUCOES", "busca_geral", montar_indice_geral)
+    posicoes = buscar_no_indice_geral(indice, termo)
+    return set(indice["ids"][posicoes]) if len(indice["ids"]) else set()
+
+# --- ÍNDICE DE NF (X3 / OC / REGISTRO) ---
+# A busca por NF no Processo_Devolucao consultava três bases com regex e
+# str.contains a cada clique. Aqui cada aba ganha, por snapshot, um dicionário
+# NF normalizada -> posições das linhas; na OC, um índice invertido de toda NF
+# citada no texto livre "Notas fiscais - motivo" -> (linha, motivo daquela NF).
+
+_PADRAO_NF_TEXTO = r'\d+(?:\.\d{3})*'
+
+def normalizar_nf(valor):
+    """'000123', '123.0', ' 123 ' -> '123'."""
+    texto = str(valor).strip()
+    if texto.endswith(".0"):
+        texto = texto[:-2]
+    return texto.lstrip("0")
+
+def _normalizar_nfs(serie):
+    return serie.astype(str).str.strip().str.replace(r'\.0$', '', regex=True).str.lstrip("0")
+
+def _coluna_sem_espacos(df, coluna):
+    for c in df.columns:
+        if str(c).strip() == coluna:
+            return c
+    return None
+
+def _indexar_nf(df, coluna):
+    col = _coluna_sem_espacos(df, coluna)
+    if df.empty or col is None:
+        return {"df": df, "posicoes": {}}
+    chaves = _normalizar_nfs(df[col])
+    posicoes = chaves[chaves != ""].groupby(chaves, sort=False).indices
+    return {"df": df, "posicoes": posicoes}
+
+def _indexar_nf_motivos(df, coluna):
+    col = _coluna_sem_espacos(df, coluna)
+    if df.empty or col is None:
+        return {"df": df, "nfs": {}}
+
+    # Uma entrada por linha de texto do motivo; "posicao" é a linha da aba
+    linhas = df[col].astype(str).reset_index(drop=True).str.split("\n").explode()
+    linhas = linhas[linhas.str.strip() != ""]
+    posicao_da_linha = linhas.index.to_numpy()
+    linhas = linhas.reset_index(drop=True)
+
+    nfs = linhas.str.findall(_PADRAO_NF_TEXTO).explode().dropna()
+    nfs = nfs.str.replace(".", "", regex=False).str.lstrip("0")
+    nfs = nfs[nfs != ""]
+    # Primeira ocorrência vence (mesmo critério do str.contains + iloc[0] antigo)
+    nfs = nfs[~nfs.duplicated()]
+
+    texto_linha = linhas.loc[nfs.index]
+    partes = texto_linha.str.split("-", n=1)
+    motivo = partes.str[1].str.strip().where(partes.str.len() > 1, texto_linha)
+
+    indice = {
+        nf: (int(pos), mot)
+        for nf, pos, mot in zip(nfs.to_numpy(), posicao_da_linha[nfs.index.to_numpy()], motivo.to_numpy())
+    }
+    return {"df": df, "nfs": indice}
+
+def _indexar_trechos_nf(df, coluna):
+    """
+    Para a busca parcial: todos os sufixos das NFs indexadas, ordenados, com a
+    primeira linha da NF de origem. "trecho dentro da NF" = "começo de algum
+    sufixo", achado por busca binária em vez de varrer as chaves.
+    """
+    indice = _indexar_nf(df, coluna)
+    pares = sorted((chave[i:], int(pos[0])) for chave, pos in indice["posicoes"].items() for i in range(len(chave)))
+    return {
+        "df": indice["df"],
+        "sufixos": [sufixo for sufixo, _ in pares],
+        "posicoes": np.array([pos for _, pos in pares], dtype=np.int64)
+    }
+
+def _linha_como_dict(df, posicao):
+    return {str(k).strip(): v for k, v in df.iloc[posicao].to_dict().items()}
+
+def buscar_linha_por_nf(nome_da_aba, coluna, nf, parcial=False):
+    """
+    Primeira linha da aba cuja coluna de NF bate com 'nf' (dict com nomes de
+    coluna sem espaços, {} se não achou). Com parcial=True, se não houver match
+    exato procura a NF como trecho das NFs indexadas (índice de sufixos, montado
+    na primeira busca parcial de cada snapshot).
+    """
+    indice = obter_derivado(nome_da_aba, f"nf:{coluna}", lambda df: _indexar_nf(df, coluna))
+    posicoes = indice["posicoes"]
+    busca = normalizar_nf(nf)
+    if not busca:
+        return {}
+
+    if busca in posicoes:
+        return _linha_como_dict(indice["df"], posicoes[busca][0])
+
+    if parcial:
+        trechos = obter_derivado(nome_da_aba, f"nf_trechos:{coluna}", lambda df: _indexar_trechos_nf(df, coluna))
+        ini = bisect_left(trechos["sufixos"], busca)
+        fim = bisect_left(trechos["sufixos"], busca + "\U0010ffff")
+        if fim > ini:
+            return _linha_como_dict(trechos["df"], int(trechos["posicoes"][ini:fim].min()))
+    return {}
+
+def buscar_motivo_por_nf(nome_da_aba, coluna, nf):
+    """
+    Linha da OC que cita a NF no texto de motivos e o motivo daquela NF
+    (texto depois do '-'). Retorna ({}, "") se a NF não aparece.
+    """
+    indice = obter_derivado(nome_da_aba, f"nf_motivos:{coluna}", lambda df: _indexar_nf_motivos(df, coluna))
+    achado = indice["nfs"].get(normalizar_nf(nf))
+    if achado is None:
+        return {}, ""
+    posicao, motivo = achado
+    return _linha_como_dict(indice["df"], posicao), motivo
 
 # ==============================================================================
 # 2. ESCRITA SEGURA (CQRS - Command) - Via API Gspread
@@ -132,30 +737,390 @@ def get_gspread_client():
         
         # 4. Tenta AutenticarQ
         creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPE)
-        return gspread.authorize(creds)
+        # Todo request do gspread passa pelo limite de cota (services/cota_api.py)
+        return gspread.authorize(creds, http_client=ClienteHTTPComCota)
 
     except Exception as e:
         debug_key = st.secrets["gcp"]["private_key"][:50] if "gcp" in st.secrets else "N/A"
         st.error(f"Erro Fatal Auth: {e} | Início da chave lida: {debug_key}...")
         return None
     
+# --- HANDLES E CABEÇALHOS CACHEADOS ---
+# open_by_key e sh.worksheet custam uma chamada de metadados cada. Abrimos a
+# planilha uma vez, registramos todas as abas numa chamada só (sh.worksheets())
+# e reaproveitamos os handles por VALIDADE_HANDLES. O cabeçalho (linha 1) de cada
+# aba também fica guardado: só é relido se faltar uma coluna que o comando
+# precisa ou se o snapshot (CSV) mostrar um cabeçalho diferente.
+_HANDLES = {"planilha": None, "abas": {}, "ts": 0.0}
+_HEADERS = {}
+_LOCK_HANDLES = threading.Lock()
+
+def _registrar_handles(client):
+    sh = client.open_by_key(st.secrets["ID_PLANILHA"])
+    _HANDLES["planilha"] = sh
+    _HANDLES["abas"] = {ws.title: ws for ws in sh.worksheets()}
+    _HANDLES["ts"] = time.time()
+
 def get_worksheet_write(nome_aba):
-    """Pega a aba usando o cliente cacheado."""
+    """Pega a aba usando o cliente e os handles cacheados."""
     client = get_gspread_client()
     if not client: return None
     
     try:
-        # Abre planilha pelo ID
-        sh = client.open_by_key(st.secrets["ID_PLANILHA"])
-        return sh.worksheet(nome_aba)
+        with _LOCK_HANDLES:
+            expirado = time.time() - _HANDLES["ts"] > VALIDADE_HANDLES
+            if _HANDLES["planilha"] is None or expirado or nome_aba not in _HANDLES["abas"]:
+                _registrar_handles(client)
+            ws = _HANDLES["abas"].get(nome_aba)
+        if ws is None:
+            raise gspread.exceptions.WorksheetNotFound(nome_aba)
+        return ws
     except Exception as e:
         st.error(f"Erro ao abrir aba '{nome_aba}': {e}")
         return None
 
+def get_planilha_write():
+    """Planilha (gspread.Spreadsheet) cacheada, para chamadas que envolvem várias abas de uma vez."""
+    if get_worksheet_write("REGISTRO_DEVOLUCOES") is None:
+        return None
+    return _HANDLES["planilha"]
+
+def _cabecalho(ws, nome_aba, exigir=()):
+    """Cabeçalho (linha 1) da aba, sem ir à API quando o cache ainda confere."""
+    header = _HEADERS.get(nome_aba)
+    snap = _SNAPSHOTS.get(nome_aba)
+    colunas_snapshot = [str(c) for c in snap["df"].columns] if snap is not None else None
+
+    desatualizado = (
+        header is None
+        or any(c not in header for c in exigir)
+        or (colunas_snapshot is not None and header[:len(colunas_snapshot)] != colunas_snapshot)
+    )
+    if desatualizado:
+        header = ws.row_values(1)
+        _HEADERS[nome_aba] = header
+    return header
+
 # ==============================================================================
 # FUNÇÕES DE COMANDO (SALVAR/ATUALIZAR)
 # ==============================================================================
 
+# Invalidação por aba: cada comando declara as abas que escreveu e só elas (mais
+# os caches derivados delas) são invalidadas. Nada de st.cache_data.clear():
+# uma mensagem no chat não pode derrubar X3, OC, USUARIOS e o Estoque de todos.
+
+_CACHES_DERIVADOS = {}  # {"modulo.funcao": (abas de origem, função @st.cache_data)}
+
+def depende_das_abas(*abas):
+    """
+    Decorator para um @st.cache_data (ou @st.cache_resource) montado a partir de abas da planilha.
+    Quando qualquer uma dessas abas for escrita, o cache da função é limpo.
+
+        @depende_das_abas("REGISTRO_DEVOLUCOES", "REGISTRO_ITENS")
+        @st.cache_data
+        def carregar_dados_consolidados(...): ...
+    """
+    def registrar(funcao_cacheada):
+        # Chave pelo nome: as páginas redefinem a função a cada rerun
+        chave = f"{funcao_cacheada.__module__}.{funcao_cacheada.__qualname__}"
+        _CACHES_DERIVADOS[chave] = (frozenset(abas), funcao_cacheada)
+        return funcao_cacheada
+    return registrar
+
+def _limpar_derivados(abas):
+    abas = set(abas)
+    for abas_origem, funcao_cacheada in list(_CACHES_DERIVADOS.values()):
+        if abas_origem & abas:
+            funcao_cacheada.clear()
+
+def invalidar_abas(abas):
+    """Após uma escrita: força a releitura só dessas abas e limpa os caches derivados delas."""
+    invalidar_snapshots(abas)
+    _limpar_derivados(abas)
+
+# --- FILA DE ESCRITA (COALESCÊNCIA) ---
+# Os comandos não chamam a API na hora: aplicam o patch otimista no snapshot,
+# entram numa fila única do processo e retornam. Um worker em segundo plano
+# junta o que chegar numa janela de JANELA_COALESCENCIA segundos e manda:
+#   - appends na mesma aba (e mesmo value_input_option) -> um append_rows
+#   - updates de células na mesma aba -> um batch_get de conferência + um batch_update
+# Cada comando recebe um Future. Se o lote falhar, os patches pendentes da aba
+# são descartados e ela é relida (a tela volta a mostrar a planilha de verdade).
+# Quem precisa confirmar (criar processo, "Salvar Tudo") espera o Future; os
+# comandos rápidos (Kanban, chat) guardam o Future na sessão e a falha aparece
+# na tela no próximo rerun (mostrar_falhas_escrita).
+# Comandos estruturais (excluir, salvar_dataframe) esperam a fila esvaziar antes.
+
+_FILA_ESCRITA = queue.Queue()
+_WORKER_ESCRITA = {"thread": None}
+_LOCK_WORKER_ESCRITA = threading.Lock()
+
+def _garantir_worker_escrita():
+    with _LOCK_WORKER_ESCRITA:
+        thread = _WORKER_ESCRITA["thread"]
+        if thread is None or not thread.is_alive():
+            thread = threading.Thread(target=_loop_worker_escrita, name="worker-escrita-sheets", daemon=True)
+            thread.start()
+            _WORKER_ESCRITA["thread"] = thread
+
+def _enfileirar(comando):
+    comando["futuro"] = Future()
+    _garantir_worker_escrita()
+    _FILA_ESCRITA.put(comando)
+    return comando["futuro"]
+
+def enfileirar_append(ws, nome_da_aba, linhas, value_input_option="RAW", aplicou_patch=True, coluna_unica=None):
+    """
+    Linhas (listas na ordem do cabeçalho) a acrescentar na aba. Retorna um Future.
+    coluna_unica: se informada, o append é recusado quando o valor dessa coluna já está na planilha.
+    """
+    return _enfileirar({"tipo": "append", "ws": ws, "aba": nome_da_aba, "linhas": linhas,
+                        "value_input_option": value_input_option, "aplicou_patch": aplicou_patch,
+                        "coluna_unica": coluna_unica})
+
+def enfileirar_update(ws, nome_da_aba, valor_chave, valores, aplicou_patch=True):
+    """Células {coluna: valor} da linha do ID a atualizar. Retorna um Future."""
+    return _enfileirar({"tipo": "update", "ws": ws, "aba": nome_da_aba, "valor_chave": str(valor_chave).strip(),
+                        "valores": dict(valores), "aplicou_patch": aplicou_patch})
+
+def enfileirar_atomico(planilha, appends, aplicou_patch=True, coluna_unica=None, abas_user_entered=()):
+    """
+    Appends em várias abas que entram juntos ou não entram (um appendCells por aba
+    no mesmo spreadsheets.batchUpdate). appends: [(ws, nome_da_aba, linhas), ...];
+    a primeira aba é a principal, onde a coluna_unica é conferida. Retorna um Future.
+    abas_user_entered: abas cujos textos viram data/número como no USER_ENTERED.
+    """
+    ws, nome_da_aba, linhas = appends[0]
+    return _enfileirar({"tipo": "atomico", "sh": planilha, "ws": ws, "aba": nome_da_aba, "linhas": linhas,
+                        "abas": [aba for _, aba, _ in appends], "appends": appends,
+                        "aplicou_patch": aplicou_patch, "coluna_unica": coluna_unica,
+                        "abas_user_entered": frozenset(abas_user_entered)})
+
+def acompanhar_na_sessao(futuro, descricao):
+    """Guarda o Future na sessão do usuário para avisar no próximo rerun se a gravação falhar."""
+    if isinstance(futuro, Future):
+        st.session_state.setdefault("_escritas_em_andamento", []).append((futuro, descricao))
+    return futuro
+
+def mostrar_falhas_escrita():
+    """Mostra (uma vez) as gravações da sessão que falharam e esquece as que já terminaram."""
+    pendentes = []
+    for futuro, descricao in st.session_state.get("_escritas_em_andamento", []):
+        if not futuro.done():
+            pendentes.append((futuro, descricao))
+        elif futuro.exception() is not None:
+            st.error(f"❌ Não foi gravado na planilha: {descricao} ({futuro.exception()})")
+    st.session_state["_escritas_em_andamento"] = pendentes
+
+def aguardar_escritas(timeout=60):
+    """Bloqueia até tudo que já está na fila ter sido gravado (ou falhado)."""
+    return _enfileirar({"tipo": "barreira"}).result(timeout=timeout)
+
+def _loop_worker_escrita():
+    while True:
+        lote = [_FILA_ESCRITA.get()]
+        limite = time.time() + JANELA_COALESCENCIA
+        # Uma barreira fecha o lote: tudo antes dela é gravado antes de liberar quem espera
+        while lote[-1]["tipo"] != "barreira":
+            restante = limite - time.time()
+            if restante <= 0:
+                break
+            try:
+                lote.append(_FILA_ESCRITA.get(timeout=restante))
+            except queue.Empty:
+                break
+        try:
+            _executar_lote(lote)
+        except Exception as e:
+            print(f"Erro inesperado no worker de escrita: {e}")
+            for comando in lote:
+                if not comando["futuro"].done():
+                    comando["futuro"].set_exception(e)
+
+def _concluir(comandos, erro=None):
+    abas = list(dict.fromkeys(aba for comando in comandos for aba in comando.get("abas", [comando["aba"]])))
+    if erro is not None:
+        print(f"Erro na escrita em lote ({', '.join(abas)}, {len(comandos)} comandos): {erro}")
+        for aba in abas:
+            descartar_patches(aba)
+        _limpar_derivados(abas)
+        for comando in comandos:
+            comando["futuro"].set_exception(erro)
+        return
+    if not all(comando["aplicou_patch"] for comando in comandos):
+        invalidar_abas(abas)
+    for comando in comandos:
+        comando["futuro"].set_result(comando.get("resultado", True))
+
+def _trocar_id_processo(comando, id_antigo, id_novo):
+    """Reescreve o ID_PROCESSO nas linhas do comando (a capa e, no atômico, os itens)."""
+    for ws, aba, linhas in comando.get("appends", [(comando["ws"], comando["aba"], comando["linhas"])]):
+        idx = _cabecalho(ws, aba, exigir=["ID_PROCESSO"]).index("ID_PROCESSO")
+        for linha in linhas:
+            if str(linha[idx]).strip() == id_antigo:
+                linha[idx] = id_novo
+
+def _separar_repetidos(ws, comandos):
+    """
+    Confere as colunas únicas numa leitura da coluna por lote: (comandos ok, comandos com valor repetido).
+    ID_PROCESSO repetido em REGISTRO_DEVOLUCOES não é recusado: o comando ganha um ID
+    novo (reservado depois de o alocador ver a coluna) e segue no lote. O Future
+    desses comandos resolve para o valor final da coluna única.
+    """
+    colunas = {c["coluna_unica"] for c in comandos if c["coluna_unica"]}
+    if not colunas:
+        return comandos, []
+    aba = comandos[0]["aba"]
+    header = _cabecalho(ws, aba, exigir=list(colunas))
+    existentes = {}
+    for coluna in colunas:
+        valores = ws.col_values(header.index(coluna) + 1)[1:]
+        if coluna == "ID_PROCESSO" and aba == "REGISTRO_DEVOLUCOES":
+            observar_ids_processo(valores)
+        existentes[coluna] = {str(v).strip() for v in valores}
+
+    ok, repetidos, trocados = [], [], []
+    for comando in comandos:
+        coluna = comando["coluna_unica"]
+        if coluna:
+            valores = {str(l[header.index(coluna)]).strip() for l in comando["linhas"]}
+            if valores & existentes[coluna]:
+                if not (coluna == "ID_PROCESSO" and aba == "REGISTRO_DEVOLUCOES" and len(valores) == 1):
+                    repetidos.append(comando)
+                    continue
+                id_antigo = valores.pop()
+                id_novo = gerar_id_processo()
+                while id_novo in existentes[coluna]:
+                    id_novo = gerar_id_processo()
+                print(f"ID {id_antigo} já existe na planilha; gravando como {id_novo}.")
+                _trocar_id_processo(comando, id_antigo, id_novo)
+                comando["aplicou_patch"] = False  # O patch otimista ficou com o ID antigo
+                trocados.append(comando)
+                valores = {id_novo}
+            existentes[coluna] |= valores  # Repetido dentro do próprio lote também conta
+            if len(valores) == 1:
+                comando["resultado"] = next(iter(valores))
+        ok.append(comando)
+
+    # Tira os patches com o ID antigo; a aba é relida depois da gravação
+    for aba_trocada in {a for c in trocados for a in c.get("abas", [c["aba"]])}:
+        descartar_patches(aba_trocada)
+    return ok, repetidos
+
+def _gravar_appends(todos, value_input_option):
+    try:
+        comandos, repetidos = _separar_repetidos(todos[0]["ws"], todos)
+        if comandos:
+            linhas = [linha for comando in comandos for linha in comando["linhas"]]
+            todos[0]["ws"].append_rows(linhas, value_input_option=value_input_option)
+    except Exception as e:
+        return _concluir(todos, e)
+    if comandos:
+        _concluir(comandos)
+    if repetidos:
+        _concluir(repetidos, ValueError(f"Valor já existe na planilha: {repetidos[0]['coluna_unica']}"))
+
+# O appendCells não interpreta texto como o USER_ENTERED do values.append. Para as
+# abas que são gravadas assim no resto do sistema (REGISTRO_ITENS), os formatos que
+# nós mesmos geramos viram o mesmo tipo que a planilha daria: data/hora (dd/mm/aaaa
+# [hh:mm:ss]) vira data com formato, e código só de dígitos vira número.
+_PADRAO_DATA_BR = re.compile(r"^(\d{2})/(\d{2})/(\d{4})(?: (\d{2}):(\d{2}):(\d{2}))?$")
+_PADRAO_INTEIRO = re.compile(r"^\d{1,15}$")  # Acima de 15 dígitos o Sheets perde precisão: fica texto
+_EPOCA_SHEETS = datetime(1899, 12, 30)
+
+def _celula(valor, user_entered=False):
+    """
+    Valor -> CellData do appendCells. Número continua número. Texto vai como texto
+    (igual ao RAW), ou, com user_entered=True, data/inteiro viram data/número.
+    """
+    if isinstance(valor, (int, float, np.integer, np.floating)) and not isinstance(valor, bool) and pd.notna(valor):
+        return {"userEnteredValue": {"numberValue": float(valor)}}
+    texto = str(valor)
+    if user_entered:
+        data = _PADRAO_DATA_BR.match(texto)
+        if data:
+            dia, mes, ano, hora, minuto, segundo = (int(p) if p else 0 for p in data.groups())
+            try:
+                serial = (datetime(ano, mes, dia, hora, minuto, segundo) - _EPOCA_SHEETS) / timedelta(days=1)
+            except ValueError:
+                return {"userEnteredValue": {"stringValue": texto}}
+            com_hora = data.group(4) is not None
+            formato = {"type": "DATE_TIME", "pattern": "dd/mm/yyyy hh:mm:ss"} if com_hora else {"type": "DATE", "pattern": "dd/mm/yyyy"}
+            return {"userEnteredValue": {"numberValue": serial}, "userEnteredFormat": {"numberFormat": formato}}
+        if _PADRAO_INTEIRO.match(texto):
+            return {"userEnteredValue": {"numberValue": float(texto)}}
+    return {"userEnteredValue": {"stringValue": texto}}
+
+def _gravar_atomicos(todos):
+    try:
+        comandos, repetidos = _separar_repetidos(todos[0]["ws"], todos)
+        requests_append = [
+            {"appendCells": {
+                "sheetId": ws.id,
+                "rows": [{"values": [_celula(v, aba in comando["abas_user_entered"]) for v in linha]} for linha in linhas],
+                "fields": "userEnteredValue,userEnteredFormat.numberFormat"
+            }}
+            for comando in comandos for ws, aba, linhas in comando["appends"] if linhas
+        ]
+        if requests_append:
+            todos[0]["sh"].batch_update({"requests": requests_append})
+    except Exception as e:
+        return _concluir(todos, e)
+    if comandos:
+        _concluir(comandos)
+    if repetidos:
+        _concluir(repetidos, ValueError(f"Valor já existe na planilha: {repetidos[0]['coluna_unica']}"))
+
+def _gravar_updates(comandos):
+    aba, ws = comandos[0]["aba"], comandos[0]["ws"]
+    # Vários updates do mesmo ID viram um só (o último valor de cada coluna vence)
+    por_chave = {}
+    for comando in comandos:
+        por_chave.setdefault(comando["valor_chave"], {}).update(comando["valores"])
+
+    try:
+        linhas, header = _localizar_linhas(ws, aba, list(por_chave))
+        celulas = []
+        for valor_chave, valores in por_chave.items():
+            linha = linhas.get(valor_chave)
+            if not linha:
+                continue
+            for coluna, valor in valores.items():
+                if coluna in header:
+                    celulas.append({"range": gspread.utils.rowcol_to_a1(linha, header.index(coluna) + 1), "values": [[valor]]})
+        if celulas:
+            ws.batch_update(celulas, value_input_option="USER_ENTERED")
+    except Exception as e:
+        return _concluir(comandos, e)
+
+    achados = [c for c in comandos if c["valor_chave"] in linhas]
+    perdidos = [c for c in comandos if c["valor_chave"] not in linhas]
+    if achados:
+        _concluir(achados)
+    if perdidos:
+        _concluir(perdidos, KeyError(f"ID não encontrado na planilha: {perdidos[0]['valor_chave']}"))
+
+def _executar_lote(lote):
+    appends, atomicos, updates = {}, {}, {}
+    for comando in lote:
+        if comando["tipo"] == "append":
+            appends.setdefault((comando["aba"], comando["value_input_option"]), []).append(comando)
+        elif comando["tipo"] == "atomico":
+            atomicos.setdefault(comando["aba"], []).append(comando)
+        elif comando["tipo"] == "update":
+            updates.setdefault(comando["aba"], []).append(comando)
+
+    for (_, value_input_option), comandos in appends.items():
+        _gravar_appends(comandos, value_input_option)
+    for comandos in atomicos.values():
+        _gravar_atomicos(comandos)
+    for comandos in updates.values():
+        _gravar_updates(comandos)
+
+    for comando in lote:
+        if comando["tipo"] == "barreira":
+            comando["futuro"].set_result(True)
+
 def salvar_mensagem(id_processo, usuario, texto, link_anexo=""):
     try:
         ws = get_worksheet_write("REGISTRO_MENSAGENS")
@@ -172,50 +1137,99 @@ def salvar_mensagem(id_processo, usuario, texto, link_anexo=""):
             str(texto),
             str(link_anexo)
         ]
-        ws.append_row(nova_msg)
-        st.cache_data.clear()
-        return True
+        aplicou = patch_append("REGISTRO_MENSAGENS", [nova_msg])
+        _limpar_derivados(["REGISTRO_MENSAGENS"])
+        futuro = enfileirar_append(ws, "REGISTRO_MENSAGENS", [nova_msg], aplicou_patch=aplicou)
+        return acompanhar_na_sessao(futuro, f"mensagem no processo {id_processo}")
     except Exception as e:
         st.error(f"Erro ao salvar mensagem: {e}")
         return False
 
+# --- ALOCADOR DE ID_PROCESSO ---
+# O último sequencial (#DEVaaaamm-NNN) fica em memória, compartilhado por todas as
+# sessões do processo. A semente vem do snapshot de REGISTRO_DEVOLUCOES, calculada
+# de forma vetorizada uma vez por versão (sem baixar a aba nem varrer ID a ID).
+# Cada reserva incrementa sob lock: duas sessões salvando juntas nunca recebem o
+# mesmo número. Na gravação, o worker confere a coluna ID_PROCESSO da planilha
+# (outra réplica pode ter usado o número); se o ID já existir, reserva outro,
+# reescreve as linhas (capa e itens) e grava com o ID novo.
+# O sequencial é único no histórico todo (não reinicia a cada mês).
+
+_PADRAO_ID_PROCESSO = r'^#DEV\d{6}-(\d+)$'
+_SEQ_ID_PROCESSO = {"ultimo": 0}
+_LOCK_ID_PROCESSO = threading.Lock()
+
+def _maior_sequencial(ids):
+    """Maior NNN entre os IDs '#DEVaaaamm-NNN' (None se não houver nenhum)."""
+    seq = pd.to_numeric(pd.Series(ids, dtype=object).astype(str).str.strip().str.extract(_PADRAO_ID_PROCESSO)[0], errors='coerce')
+    return int(seq.max()) if seq.notna().any() else None
+
+def _maior_sequencial_da_aba(df):
+    if df.empty or "ID_PROCESSO" not in df.columns:
+        return None
+    return _maior_sequencial(df["ID_PROCESSO"]) or 0
+
+def observar_ids_processo(ids):
+    """Atualiza o alocador com IDs lidos da planilha (o contador nunca volta para trás)."""
+    maior = _maior_sequencial(ids) or 0
+    with _LOCK_ID_PROCESSO:
+        _SEQ_ID_PROCESSO["ultimo"] = max(_SEQ_ID_PROCESSO["ultimo"], maior)
+
 def gerar_id_processo():
+    agora = datetime.now(TZ_BR)
     try:
-        # Pega a hora certa no Brasil
-        agora = datetime.now(TZ_BR)
-        
-        df = carregar_dados("REGISTRO_DEVOLUCOES")
-        
-        # Fallback de segurança: Se falhar a leitura, gera ID com timestamp BR
-        if df.empty or "ID_PROCESSO" not in df.columns:
-             timestamp = agora.strftime('%Y%m%d-%H%M%S')
-             return f"#DEV{timestamp}"
-             
-        # Lógica de Sequencial
-        ids_existentes = df["ID_PROCESSO"].astype(str).tolist()
-        ids_dev = [x for x in ids_existentes if str(x).startswith("#DEV")]
-        
-        if not ids_dev:
-            seq = 1
-        else:
-            numeros = []
-            for id_proc in ids_dev:
-                try:
-                    parts = id_proc.split('-')
-                    if len(parts) > 1:
-                        num = int(parts[-1])
-                        numeros.append(num)
-                except: continue
-            seq = max(numeros) + 1 if numeros else 1
-        
-        # Gera o prefixo com o Ano/Mês CORRETOS do Brasil
-        ano_mes = agora.strftime("%Y%m")
-        return f"#DEV{ano_mes}-{seq:03d}"
-        
+        semente = obter_derivado("REGISTRO_DEVOLUCOES", "maior_sequencial", _maior_sequencial_da_aba)
     except Exception as e:
-        print(f"Erro ao gerar ID: {e}")
-        # Fallback também com ZoneInfo
-        return f"#DEV{datetime.now(TZ_BR).strftime('%Y%m%d-%H%M%S')}"
+        print(f"Erro ao ler a semente do ID: {e}")
+        semente = None
+
+    with _LOCK_ID_PROCESSO:
+        # Fallback de segurança: sem snapshot e sem nada reservado, ID com timestamp BR
+        if semente is None and _SEQ_ID_PROCESSO["ultimo"] == 0:
+            return f"#DEV{agora.strftime('%Y%m%d-%H%M%S')}"
+        seq = max(_SEQ_ID_PROCESSO["ultimo"], semente or 0) + 1
+        _SEQ_ID_PROCESSO["ultimo"] = seq
+
+    # Prefixo com o Ano/Mês CORRETOS do Brasil
+    return f"#DEV{agora.strftime('%Y%m')}-{seq:03d}"
+
+def _linha_do_processo(headers, dados, id_processo, data_hoje):
+    """Linha da capa na ordem do cabeçalho de REGISTRO_DEVOLUCOES."""
+    nova_linha = [""] * len(headers)
+    
+    mapa_colunas = {
+        "ID_PROCESSO": "ID_PROCESSO",
+        "DATA_CRIACAO": "DATA_CRIACAO",
+        "STATUS": "STATUS",
+        "COB_DATA": "COB_DATA",
+        "ORDEM_DE_CARGA": "ORDEM_DE_CARGA",
+        "DATA_DEVOLUCAO_CTE": "DATA_DEVOLUCAO_CTE",
+        "NF": "NF",
+        "CTE": "CTE",
+        "DATA_EMISSAO": "DATA_EMISSAO",
+        "VEICULO": "VEICULO",
+        "TIPO_VEICULO": "TIPO_VEICULO",
+        "MOTORISTA": "MOTORISTA",
+        "OC": "OC",
+        "DATA_INICIO": "DATA_INICIO",
+        "DATA_FIM": "DATA_FIM",
+        "STATUS_OC": "STATUS_OC",
+        "PRAZO": "PRAZO",
+        "TIPO_CARGA": "TIPO_CARGA",
+        "LOCAL": "LOCAL",
+        "MOTIVO": "MOTIVO",
+        "RESPONSAVEL": "RESPONSAVEL",
+        "LINK_NFD": "LINK_NFD" 
+    }
+    
+    for chave_pacote, nome_coluna in mapa_colunas.items():
+        if nome_coluna in headers:
+            index = headers.index(nome_coluna)
+            if chave_pacote == "ID_PROCESSO": nova_linha[index] = id_processo
+            elif chave_pacote == "DATA_CRIACAO": nova_linha[index] = data_hoje
+            elif chave_pacote == "STATUS": nova_linha[index] = "ABERTO"
+            else: nova_linha[index] = str(dados.get(chave_pacote, ""))
+    return nova_linha
 
 def salvar_novo_processo(dados):
     try:
@@ -225,134 +1239,283 @@ def salvar_novo_processo(dados):
         id_processo = gerar_id_processo()
         data_hoje = get_data_atual_br() 
         
-        headers = ws.row_values(1)
-        nova_linha = [""] * len(headers)
-        
-        mapa_colunas = {
-            "ID_PROCESSO": "ID_PROCESSO",
-            "DATA_CRIACAO": "DATA_CRIACAO",
-            "STATUS": "STATUS",
-            "COB_DATA": "COB_DATA",
-            "ORDEM_DE_CARGA": "ORDEM_DE_CARGA",
-            "DATA_DEVOLUCAO_CTE": "DATA_DEVOLUCAO_CTE",
-            "NF": "NF",
-            "CTE": "CTE",
-            "DATA_EMISSAO": "DATA_EMISSAO",
-            "VEICULO": "VEICULO",
-            "TIPO_VEICULO": "TIPO_VEICULO",
-            "MOTORISTA": "MOTORISTA",
-            "OC": "OC",
-            "DATA_INICIO": "DATA_INICIO",
-            "DATA_FIM": "DATA_FIM",
-            "STATUS_OC": "STATUS_OC",
-            "PRAZO": "PRAZO",
-            "TIPO_CARGA": "TIPO_CARGA",
-            "LOCAL": "LOCAL",
-            "MOTIVO": "MOTIVO",
-            "RESPONSAVEL": "RESPONSAVEL",
-            "LINK_NFD": "LINK_NFD" 
-        }
-        
-        for chave_pacote, nome_coluna in mapa_colunas.items():
-            if nome_coluna in headers:
-                index = headers.index(nome_coluna)
-                if chave_pacote == "ID_PROCESSO": nova_linha[index] = id_processo
-                elif chave_pacote == "DATA_CRIACAO": nova_linha[index] = data_hoje
-                elif chave_pacote == "STATUS": nova_linha[index] = "ABERTO"
-                else: nova_linha[index] = str(dados.get(chave_pacote, ""))
-
-        ws.append_row(nova_linha)
-        st.cache_data.clear()
-        return True, id_processo
+        headers = _cabecalho(ws, "REGISTRO_DEVOLUCOES", exigir=["ID_PROCESSO"])
+        nova_linha = _linha_do_processo(headers, dados, id_processo, data_hoje)
+
+        aplicou = patch_append("REGISTRO_DEVOLUCOES", [dict(zip(headers, nova_linha))])
+        _limpar_derivados(["REGISTRO_DEVOLUCOES"])
+        futuro = enfileirar_append(ws, "REGISTRO_DEVOLUCOES", [nova_linha], aplicou_patch=aplicou, coluna_unica="ID_PROCESSO")
+        return futuro, id_processo
 
     except Exception as e:
         st.error(f"Erro ao salvar processo: {e}")
         return False, None
 
-def salvar_dataframe(nome_da_aba, df):
+# --- ESCRITA DE DATAFRAME INTEIRO ---
+# modo="diff": compara com o snapshot e manda só os blocos de linhas que mudaram
+#   (em lotes de tamanho_lote linhas). Linhas que sobraram no fim são limpas.
+# modo="troca": escreve tudo numa aba temporária e troca num batch_update só
+#   (apaga a antiga + duplica a temporária com o MESMO gid e nome + apaga a
+#   temporária). A aba nunca aparece vazia e o gid usado no CSV export não muda.
+#   Só quando pedido: apagar a aba quebra (#REF!) fórmulas, intervalos nomeados e
+#   validações de outras abas que apontam para ela, e perde formatação/proteções.
+# Sem snapshot utilizável (ou com colunas diferentes), o diff é feito contra os
+# valores lidos da planilha pela API, reescrevendo o cabeçalho se ele mudou.
+
+def _como_texto(df):
+    """DataFrame -> texto como vai para a planilha (NaN vira '', float inteiro do CSV vira '123')."""
+    texto = df.astype(object).where(df.notna(), "").astype(str)
+    for col in df.columns[[pd.api.types.is_float_dtype(t) for t in df.dtypes]]:
+        numeros = df[col]
+        inteiros = numeros.notna() & (numeros % 1 == 0)
+        texto.loc[inteiros, col] = numeros[inteiros].astype("int64").astype(str)
+    return texto
+
+def _em_lotes(linhas, tamanho):
+    for inicio in range(0, len(linhas), tamanho):
+        yield inicio, linhas[inicio:inicio + tamanho]
+
+def _ultima_coluna(qtd_colunas):
+    return gspread.utils.rowcol_to_a1(1, max(qtd_colunas, 1))[:-1]
+
+def _salvar_por_diff(ws, novo, atual, tamanho_lote):
+    fim_col = _ultima_coluna(len(novo.columns))
+    comuns = min(len(novo), len(atual))
+    mudou = (novo.iloc[:comuns].to_numpy() != atual.iloc[:comuns].to_numpy()).any(axis=1)
+    linhas = list(np.flatnonzero(mudou) + 2) + list(range(comuns + 2, len(novo) + 2))
+
+    # Blocos contíguos (de cima para baixo), quebrados em lotes de no máximo tamanho_lote linhas
+    blocos = []
+    for inicio, fim in reversed(_faixas_de_linhas(linhas)):
+        for desloc in range(0, fim - inicio + 1, tamanho_lote):
+            a, b = inicio + desloc, min(inicio + desloc + tamanho_lote - 1, fim)
+            blocos.append({"range": f"A{a}:{fim_col}{b}", "values": novo.iloc[a - 2:b - 1].values.tolist()})
+
+    lote, linhas_no_lote = [], 0
+    for bloco in blocos:
+        if lote and linhas_no_lote + len(bloco["values"]) > tamanho_lote:
+            ws.batch_update(lote)
+            lote, linhas_no_lote = [], 0
+        lote.append(bloco)
+        linhas_no_lote += len(bloco["values"])
+    if lote:
+        ws.batch_update(lote)
+
+    if len(atual) > len(novo):
+        ws.batch_clear([f"A{len(novo) + 2}:{fim_col}{len(atual) + 1}"])
+
+def _ler_para_diff(ws, qtd_colunas):
+    """
+    Valores atuais da aba pela API: (cabeçalho, DataFrame de texto com qtd_colunas
+    colunas, largura usada na planilha). Base do diff quando não há snapshot.
+    """
+    valores = ws.get_all_values()
+    largura = max([qtd_colunas] + [len(linha) for linha in valores])
+    grade = [linha + [""] * (largura - len(linha)) for linha in valores]
+    cabecalho = grade[0] if grade else []
+    atual = pd.DataFrame([linha[:qtd_colunas] for linha in grade[1:]], columns=range(qtd_colunas))
+    return cabecalho, atual, max([len(linha) for linha in valores], default=0)
+
+def _salvar_por_troca(ws, novo, tamanho_lote):
+    sh = get_planilha_write()
+    titulo_tmp = f"{ws.title}__tmp_{uuid.uuid4().hex[:6]}"
+    resposta = sh.batch_update({"requests": [{"addSheet": {"properties": {
+        "title": titulo_tmp,
+        "gridProperties": {"rowCount": len(novo) + 1, "columnCount": max(len(novo.columns), 1)}
+    }}}]})
+    id_tmp = resposta["replies"][0]["addSheet"]["properties"]["sheetId"]
+
     try:
+        dados = [novo.columns.tolist()] + novo.values.tolist()
+        for inicio, lote in _em_lotes(dados, tamanho_lote):
+            sh.values_update(f"'{titulo_tmp}'!A{inicio + 1}", params={"valueInputOption": "RAW"}, body={"values": lote})
+    except Exception:
+        sh.batch_update({"requests": [{"deleteSheet": {"sheetId": id_tmp}}]})
+        raise
+
+    # A troca em si: um batch_update é atômico (tudo ou nada)
+    sh.batch_update({"requests": [
+        {"deleteSheet": {"sheetId": ws.id}},
+        {"duplicateSheet": {"sourceSheetId": id_tmp, "newSheetId": ws.id, "newSheetName": ws.title, "insertSheetIndex": ws.index}},
+        {"deleteSheet": {"sheetId": id_tmp}},
+    ]})
+
+def salvar_dataframe(nome_da_aba, df, modo="diff", tamanho_lote=TAMANHO_LOTE_ESCRITA):
+    try:
+        aguardar_escritas()
         ws = get_worksheet_write(nome_da_aba)
         if not ws: return False
         
-        ws.clear()
         # Converte tudo para string para evitar erros de serialização JSON
-        df = df.fillna("").astype(str) 
-        lista_dados = [df.columns.values.tolist()] + df.values.tolist()
-        ws.update(lista_dados)
-        st.cache_data.clear()
+        novo = _como_texto(df)
+        snap = _SNAPSHOTS.get(nome_da_aba)
+
+        if modo == "troca":
+            _salvar_por_troca(ws, novo, tamanho_lote)
+        elif snap is not None and not snap["invalido"] and list(snap["df"].columns) == list(novo.columns):
+            _salvar_por_diff(ws, novo, _como_texto(snap["df"]), tamanho_lote)
+        else:
+            cabecalho, atual, largura = _ler_para_diff(ws, len(novo.columns))
+            colunas = [str(c) for c in novo.columns]
+            if cabecalho[:len(colunas)] != colunas:
+                ws.batch_update([{"range": f"A1:{_ultima_coluna(len(colunas))}1", "values": [colunas]}])
+            if largura > len(colunas):
+                # Colunas que saíram do DataFrame: limpa o que sobrou à direita
+                ws.batch_clear([f"{_ultima_coluna(len(colunas) + 1)}1:{_ultima_coluna(largura)}{len(atual) + 1}"])
+            _salvar_por_diff(ws, novo, atual, tamanho_lote)
+
+        _HEADERS[nome_da_aba] = [str(c) for c in novo.columns]
+        invalidar_abas([nome_da_aba])
         return True
     except Exception as e:
-        st.error(f"Erro delete: {e}")
+        st.error(f"Erro ao salvar aba {nome_da_aba}: {e}")
         return False
 
+def _faixas_de_linhas(linhas):
+    """[7, 3, 4, 5, 9] -> [(9, 9), (7, 7), (3, 5)]: blocos contíguos, de baixo para cima."""
+    faixas = []
+    for linha in sorted(set(linhas), reverse=True):
+        if faixas and faixas[-1][0] == linha + 1:
+            faixas[-1] = (linha, faixas[-1][1])
+        else:
+            faixas.append((linha, linha))
+    return faixas
+
 def excluir_processo_completo(id_processo):
+    """
+    Apaga só as linhas do processo nas três abas.
+    1 leitura (coluna ID_PROCESSO das três abas num values_batch_get) para achar as
+    linhas reais na planilha + 1 batch_update com deleteDimension, de baixo para
+    cima, para não deslocar as linhas que ainda vão ser apagadas.
+    """
     abas_alvo = ["REGISTRO_DEVOLUCOES", "REGISTRO_ITENS", "REGISTRO_MENSAGENS"]
-    erros = []
-    
-    for aba in abas_alvo:
-        try:
-            # Lê via CSV (Rápido)
-            df = carregar_dados(aba)
-            if not df.empty and "ID_PROCESSO" in df.columns:
-                df["ID_PROCESSO"] = df["ID_PROCESSO"].astype(str) # Garante tipagem
-                mascara = df["ID_PROCESSO"] == str(id_processo)
-                
-                if mascara.any():
-                    # Filtra e reescreve a aba inteira (Estratégia mais segura que deletar linha a linha)
-                    df_novo = df[~mascara]
-                    salvar_dataframe(aba, df_novo)
-        except Exception as e:
-            erros.append(f"Erro na aba {aba}: {str(e)}")
-    
-    return len(erros) == 0
+    alvo = str(id_processo).strip()
+
+    try:
+        # Appends/updates ainda na fila mudariam as linhas depois da leitura
+        aguardar_escritas()
+        sh = get_planilha_write()
+        if sh is None: return False
+
+        abas, faixas_leitura = [], []
+        for aba in abas_alvo:
+            ws = get_worksheet_write(aba)
+            if ws is None: continue
+            header = _cabecalho(ws, aba, exigir=["ID_PROCESSO"])
+            if "ID_PROCESSO" not in header: continue
+            letra = gspread.utils.rowcol_to_a1(1, header.index("ID_PROCESSO") + 1)[:-1]
+            abas.append((aba, ws))
+            faixas_leitura.append(f"'{ws.title}'!{letra}:{letra}")
+
+        if not abas: return False
+        lidos = sh.values_batch_get(faixas_leitura).get("valueRanges", [])
+
+        requests_delete = []
+        for (aba, ws), faixa in zip(abas, lidos):
+            valores = faixa.get("values", [])
+            # Linha 1 é o cabeçalho; a planilha numera a partir de 1
+            linhas = [i + 1 for i, v in enumerate(valores) if i > 0 and v and str(v[0]).strip() == alvo]
+            for inicio, fim in _faixas_de_linhas(linhas):
+                requests_delete.append({"deleteDimension": {"range": {
+                    "sheetId": ws.id, "dimension": "ROWS",
+                    "startIndex": inicio - 1, "endIndex": fim
+                }}})
+
+        if requests_delete:
+            sh.batch_update({"requests": requests_delete})
+        invalidar_abas([aba for aba, _ in abas])
+        return True
+    except Exception as e:
+        st.error(f"Erro ao excluir processo: {e}")
+        return False
+
+def _mesmo_valor(atual, novo):
+    """Compara o valor do snapshot (CSV) com o que vai ser gravado: '123.0' == '123'."""
+    return _normalizar_celula(atual) == _normalizar_celula(novo)
+
+def _linha_em_cache(nome_da_aba, id_processo):
+    """Linha do processo no snapshot (dict) ou None se não estiver lá."""
+    df = _linhas_do_processo(nome_da_aba, id_processo)
+    return df.iloc[0].to_dict() if not df.empty else None
+
+# --- LOCALIZAÇÃO DAS LINHAS NA PLANILHA (SEM ws.find) ---
+# O snapshot já sabe em que posição cada ID_PROCESSO está: linha na planilha =
+# posição no CSV + 2 (linha 1 é o cabeçalho). Os palpites de todos os IDs do lote
+# são conferidos numa leitura só (cabeçalho + linhas dos palpites no mesmo
+# batch_get). O Sheets não tem leitura condicional dentro da escrita, então a
+# conferência é uma chamada separada, mas substitui o find + row_values. O que não
+# bater (alguém inseriu/apagou linhas) é resolvido lendo só a coluna-chave.
+
+def _localizar_linhas(ws, nome_da_aba, valores_chave, chave="ID_PROCESSO"):
+    """Retorna ({valor_chave: número da linha}, cabeçalho). IDs que não estão na planilha ficam de fora."""
+    valores_chave = [str(v).strip() for v in valores_chave]
+    indice = obter_derivado(nome_da_aba, "por_processo", _indexar_por_processo)
+    posicoes = indice["posicoes"] or {}
+    palpites = {v: int(posicoes[v][0]) + 2 for v in valores_chave if len(posicoes.get(v, []))}
+
+    lidos = ws.batch_get(["1:1"] + [f"{p}:{p}" for p in palpites.values()])
+    header = list(lidos[0][0]) if lidos[0] else []
+    _HEADERS[nome_da_aba] = header
+    if chave not in header:
+        return {}, header
+    col_chave = header.index(chave)
+
+    linhas = {}
+    for (valor, palpite), lido in zip(palpites.items(), lidos[1:]):
+        linha_lida = lido[0] if lido else []
+        if col_chave < len(linha_lida) and str(linha_lida[col_chave]).strip() == valor:
+            linhas[valor] = palpite
+
+    faltando = [v for v in valores_chave if v not in linhas]
+    if faltando:
+        print(f"Índice de linhas desatualizado em {nome_da_aba} ({len(faltando)} IDs); lendo a coluna-chave.")
+        coluna = ws.col_values(col_chave + 1)
+        primeira = {}
+        for numero, valor in enumerate(coluna[1:], start=2):
+            primeira.setdefault(str(valor).strip(), numero)
+        linhas.update({v: primeira[v] for v in faltando if v in primeira})
+    return linhas, header
 
 def atualizar_tratativa_completa(id_processo, novo_status_log, novo_status_fisc, cod_cob, link_anexo_cob, link_anexo_cte, cod_cte, veiculo, motorista, local_atual, local_destino, oc, data_cte, cob_data, ordem_de_carga):
     try:
+        # Formatação segura de datas
+        dt_cte = data_cte.strftime("%d/%m/%Y") if isinstance(data_cte, (date, datetime)) else str(data_cte)
+        dt_cob = cob_data.strftime("%d/%m/%Y") if isinstance(cob_data, (date, datetime)) else str(cob_data)
+
+        updates = [
+            ("STATUS", novo_status_log),
+            ("STATUS_FISCAL", novo_status_fisc),
+            ("COD_COB", cod_cob),
+            ("COB_ANEXO", link_anexo_cob),
+            ("COD_CTE", cod_cte),
+            ("DATA_DEVOLUCAO_CTE", dt_cte),
+            ("COB_DATA", dt_cob),
+            ("CTE_ANEXO", link_anexo_cte),
+            ("VEICULO", veiculo),
+            ("ORDEM_DE_CARGA", ordem_de_carga),
+            ("OC", oc),
+            ("MOTORISTA", motorista),
+            ("LOCAL_ATUAL", local_atual),
+            ("LOCAL_DESTINO", local_destino)
+        ]
+        # Lógica para não apagar anexo se vier vazio
+        updates = [(col, valor) for col, valor in updates if not (col in ["COB_ANEXO", "CTE_ANEXO"] and not valor)]
+
+        # Só manda o que mudou em relação à linha do snapshot
+        linha_atual = _linha_em_cache("REGISTRO_DEVOLUCOES", id_processo)
+        if linha_atual is not None:
+            updates = [(col, valor) for col, valor in updates if not (col in linha_atual and _mesmo_valor(linha_atual[col], valor))]
+            if not updates:
+                return True
+
         ws = get_worksheet_write("REGISTRO_DEVOLUCOES")
         if not ws: return False
         
-        cell = ws.find(id_processo)
-        
-        if cell:
-            header = ws.row_values(1)
-            def get_idx(nome):
-                try: return header.index(nome) + 1
-                except ValueError: return None
-            
-            # Formatação segura de datas
-            dt_cte = data_cte.strftime("%d/%m/%Y") if isinstance(data_cte, (date, datetime)) else str(data_cte)
-            dt_cob = cob_data.strftime("%d/%m/%Y") if isinstance(cob_data, (date, datetime)) else str(cob_data)
-
-            updates = [
-                ("STATUS", novo_status_log),
-                ("STATUS_FISCAL", novo_status_fisc),
-                ("COD_COB", cod_cob),
-                ("COB_ANEXO", link_anexo_cob),
-                ("COD_CTE", cod_cte),
-                ("DATA_DEVOLUCAO_CTE", dt_cte),
-                ("COB_DATA", dt_cob),
-                ("CTE_ANEXO", link_anexo_cte),
-                ("VEICULO", veiculo),
-                ("ORDEM_DE_CARGA", ordem_de_carga),
-                ("OC", oc),
-                ("MOTORISTA", motorista),
-                ("LOCAL_ATUAL", local_atual),
-                ("LOCAL_DESTINO", local_destino)
-            ]
-
-            # Nota de Performance: Isso aqui faz 1 request por célula. 
-            # Em produção massiva, deveríamos usar batch_update, mas para uso atual está ok.
-            for col_nome, valor in updates:
-                idx = get_idx(col_nome)
-                if idx:
-                    # Lógica para não apagar anexo se vier vazio
-                    if col_nome in ["COB_ANEXO", "CTE_ANEXO"] and not valor:
-                        continue 
-                    ws.update_cell(cell.row, idx, valor)
-            
-            st.cache_data.clear()
-            return True
-        return False
+        # Só as colunas que existem na planilha são gravadas (o worker confere o cabeçalho)
+        valores = dict(updates)
+        aplicou = patch_update("REGISTRO_DEVOLUCOES", id_processo, valores)
+        _limpar_derivados(["REGISTRO_DEVOLUCOES"])
+        return enfileirar_update(ws, "REGISTRO_DEVOLUCOES", id_processo, valores, aplicou_patch=aplicou)
     except Exception as e:
         st.error(f"Erro ao atualizar tratativa: {e}")
         return False
@@ -362,54 +1525,113 @@ def atualizar_status_devolucao(id_processo, novo_status):
         ws = get_worksheet_write("REGISTRO_DEVOLUCOES")
         if not ws: return False
         
-        cell = ws.find(id_processo)
-        if cell:
-            header = ws.row_values(1)
-            col_index = header.index("STATUS") + 1 if "STATUS" in header else 8
-            ws.update_cell(cell.row, col_index, novo_status)
-            st.cache_data.clear()
-            return True
-        return False
+        aplicou = patch_update("REGISTRO_DEVOLUCOES", id_processo, {"STATUS": novo_status})
+        _limpar_derivados(["REGISTRO_DEVOLUCOES"])
+        futuro = enfileirar_update(ws, "REGISTRO_DEVOLUCOES", id_processo, {"STATUS": novo_status}, aplicou_patch=aplicou)
+        return acompanhar_na_sessao(futuro, f"status de {id_processo} para {novo_status}")
     except Exception as e:
         st.error(f"Erro ao atualizar status: {e}")
         return False
     
+def _linhas_dos_itens(headers, id_processo, lista_itens, data_agora):
+    """Linhas de REGISTRO_ITENS na ordem do cabeçalho (QTD/valores mantêm o tipo que vieram)."""
+    novas_linhas = []
+    for item in lista_itens:
+        nova_linha = [""] * len(headers)
+        mapa = {
+            "ID_ITEM": str(uuid.uuid4())[:8],
+            "ID_PROCESSO": str(id_processo),
+            "DATA_REGISTRO": data_agora,
+            "NUMERO_NFD": str(item.get("NUMERO_NFD", "")),
+            "COD_ITEM": str(item.get("COD_ITEM", "")),
+            "DESCRICAO": str(item.get("DESCRICAO", "")),
+            "QTD": item.get("QTD", ""),
+            "VALOR_UNIT": item.get("VALOR_UNIT", ""),
+            "VALOR_TOTAL": item.get("VALOR_TOTAL", "")
+        }
+        for chave, valor in mapa.items():
+            if chave in headers:
+                nova_linha[headers.index(chave)] = valor
+        novas_linhas.append(nova_linha)
+    return novas_linhas
+
 def salvar_itens_lote(id_processo, lista_itens):
     try:
         ws = get_worksheet_write("REGISTRO_ITENS")
         if not ws: return False
 
-        headers = ws.row_values(1)
+        headers = _cabecalho(ws, "REGISTRO_ITENS", exigir=["ID_PROCESSO"])
         
         # Uso do helper global
         data_agora = get_data_atual_br()
         
-        novas_linhas = []
-        
-        for item in lista_itens:
-            nova_linha = [""] * len(headers)
-            mapa = {
-                "ID_ITEM": str(uuid.uuid4())[:8],
-                "ID_PROCESSO": str(id_processo),
-                "DATA_REGISTRO": data_agora,
-                "NUMERO_NFD": str(item.get("NUMERO_NFD", "")),
-                "COD_ITEM": str(item.get("COD_ITEM", "")),
-                "DESCRICAO": str(item.get("DESCRICAO", "")),
-                "QTD": str(item.get("QTD", "")),
-                "VALOR_UNIT": str(item.get("VALOR_UNIT", "")),
-                "VALOR_TOTAL": str(item.get("VALOR_TOTAL", ""))
-            }
-            for chave, valor in mapa.items():
-                if chave in headers:
-                    nova_linha[headers.index(chave)] = valor
-            novas_linhas.append(nova_linha)
+        linhas = _linhas_dos_itens(headers, id_processo, lista_itens, data_agora)
+        novas_linhas = [[str(valor) for valor in linha] for linha in linhas]
         
         if novas_linhas:
-            # append_rows é eficiente (1 request para N linhas)
-            ws.append_rows(novas_linhas, value_input_option="USER_ENTERED")
-            st.cache_data.clear()
-            return True
+            # Vai junto com outros appends da fila num append_rows só
+            linhas_patch = [dict(zip(headers, linha)) for linha in novas_linhas]
+            aplicou = patch_append("REGISTRO_ITENS", linhas_patch)
+            _limpar_derivados(["REGISTRO_ITENS"])
+            return enfileirar_append(ws, "REGISTRO_ITENS", novas_linhas, value_input_option="USER_ENTERED", aplicou_patch=aplicou)
         return False
     except Exception as e:
         st.error(f"Erro ao salvar itens: {e}")
-        return False
\ No newline at end of file
+        return False
+
+# --- CRIAÇÃO DO PROCESSO (CAPA + ITENS JUNTOS) ---
+
+def _validar_processo(capa, itens):
+    """Lista de problemas que impedem salvar (vazia = pode salvar)."""
+    erros = []
+    if not str(capa.get("NF", "") or "").strip():
+        erros.append("NF do processo não informada.")
+    if not itens:
+        erros.append("Adicione itens antes de salvar!")
+    for n, item in enumerate(itens, start=1):
+        if not str(item.get("NUMERO_NFD", "")).strip() or not str(item.get("COD_ITEM", "")).strip():
+            erros.append(f"Item {n}: preencha NFD e Código.")
+    return erros
+
+def criar_processo_completo(capa, itens):
+    """
+    Cria a capa (REGISTRO_DEVOLUCOES) e os itens (REGISTRO_ITENS) de uma vez.
+    Tudo é validado antes; as duas abas vão num único batchUpdate da planilha
+    (um appendCells por aba), que o Google aplica inteiro ou não aplica: não
+    sobra processo sem itens. Retorna (Future, id_processo) ou (False, None);
+    o Future resolve para o ID gravado (diferente do devolvido se houve colisão).
+    """
+    erros = _validar_processo(capa, itens)
+    if erros:
+        st.warning("⚠️ " + " ".join(erros))
+        return False, None
+
+    try:
+        sh = get_planilha_write()
+        ws_proc = get_worksheet_write("REGISTRO_DEVOLUCOES")
+        ws_itens = get_worksheet_write("REGISTRO_ITENS")
+        if sh is None or not ws_proc or not ws_itens: return False, None
+
+        headers_proc = _cabecalho(ws_proc, "REGISTRO_DEVOLUCOES", exigir=["ID_PROCESSO"])
+        headers_itens = _cabecalho(ws_itens, "REGISTRO_ITENS", exigir=["ID_PROCESSO"])
+
+        id_processo = gerar_id_processo()
+        data_hoje = get_data_atual_br()
+        linha_capa = _linha_do_processo(headers_proc, capa, id_processo, data_hoje)
+        linhas_itens = _linhas_dos_itens(headers_itens, id_processo, itens, data_hoje)
+
+        aplicou_capa = patch_append("REGISTRO_DEVOLUCOES", [dict(zip(headers_proc, linha_capa))])
+        aplicou_itens = patch_append("REGISTRO_ITENS", [dict(zip(headers_itens, map(str, linha))) for linha in linhas_itens])
+        _limpar_derivados(["REGISTRO_DEVOLUCOES", "REGISTRO_ITENS"])
+
+        futuro = enfileirar_atomico(
+            sh,
+            [(ws_proc, "REGISTRO_DEVOLUCOES", [linha_capa]), (ws_itens, "REGISTRO_ITENS", linhas_itens)],
+            aplicou_patch=aplicou_capa and aplicou_itens,
+            coluna_unica="ID_PROCESSO",
+            abas_user_entered=["REGISTRO_ITENS"]  # Igual ao salvar_itens_lote (USER_ENTERED)
+        )
+        return futuro, id_processo
+    except Exception as e:
+        st.error(f"Erro ao salvar processo: {e}")
+        return False, None
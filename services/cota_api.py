@@ -0,0 +1,144 @@
+import random
+import threading
+import time
+import requests
+from gspread.exceptions import APIError
+from gspread.http_client import HTTPClient
+
+# ==============================================================================
+# LIMITE DE COTA DO GOOGLE (TOKEN BUCKET + BACKOFF)
+# ==============================================================================
+# Toda chamada ao Google passa por um "balde" de fichas por canal:
+#   - "sheets_api": tudo que o gspread manda (leitura e escrita pela API)
+#   - "csv_export": downloads do CSV export das abas
+# O balde enche COTA_POR_MINUTO / 60 fichas por segundo até RAJADA_MAXIMA.
+# Sem ficha, a chamada espera a vez (fila) em vez de estourar a cota.
+# Se mesmo assim vier 429/5xx (ou erro de rede), tenta de novo com backoff
+# exponencial + jitter, respeitando o Retry-After quando o Google manda.
+# Só depois de MAX_TENTATIVAS o erro sobe para quem chamou.
+# A decisão é pelo endpoint, não pelo método HTTP:
+#   - leituras e escritas que regravam os mesmos valores nas mesmas células
+#     (values:batchUpdate, values PUT, clear/batchClear) repetem em 429/5xx/rede;
+#   - values:append e spreadsheets:batchUpdate (appendCells/deleteDimension) só
+#     repetem em 429, que o Google nunca aplica: num 5xx ou queda de conexão a
+#     primeira tentativa pode ter sido gravada e só a resposta se perdeu. Repetir
+#     um append duplicaria linhas, e repetir um deleteDimension (por índice)
+#     apagaria linhas de outro processo.
+
+# Cota do Sheets API: 60 requests/min por usuário (a conta de serviço é um usuário só)
+COTA_POR_MINUTO = {
+    "sheets_api": 60,
+    "csv_export": 120
+}
+RAJADA_MAXIMA = {
+    "sheets_api": 10,
+    "csv_export": 10
+}
+
+MAX_TENTATIVAS = 6
+BACKOFF_BASE = 1.0    # segundos na 1ª retentativa (dobra a cada uma)
+BACKOFF_MAXIMO = 32.0
+
+STATUS_RETENTAVEIS = {408, 429, 500, 502, 503, 504}
+STATUS_RETENTAVEIS_ESCRITA = {429}
+# Fim do endpoint das chamadas que NÃO podem ser repetidas às cegas
+ENDPOINTS_NAO_IDEMPOTENTES = (":append", ":batchUpdate", ":copyTo")
+ENDPOINTS_IDEMPOTENTES = ("/values:batchUpdate", "/values:batchClear", ":clear")
+
+# {canal: {"fichas": float, "ts": epoch da última recarga}}
+_BALDES = {canal: {"fichas": float(RAJADA_MAXIMA[canal]), "ts": time.time()} for canal in COTA_POR_MINUTO}
+# {canal: {"chamadas", "retentativas", "falhas", "espera_s"}}
+_METRICAS_COTA = {canal: {"chamadas": 0, "retentativas": 0, "falhas": 0, "espera_s": 0.0} for canal in COTA_POR_MINUTO}
+_LOCK_COTA = threading.Lock()
+
+def _aguardar_ficha(canal):
+    """Tira uma ficha do balde do canal, dormindo o necessário se ele estiver vazio."""
+    taxa = COTA_POR_MINUTO[canal] / 60.0
+    while True:
+        with _LOCK_COTA:
+            balde = _BALDES[canal]
+            agora = time.time()
+            balde["fichas"] = min(RAJADA_MAXIMA[canal], balde["fichas"] + (agora - balde["ts"]) * taxa)
+            balde["ts"] = agora
+            if balde["fichas"] >= 1:
+                balde["fichas"] -= 1
+                return
+            espera = (1 - balde["fichas"]) / taxa
+            _METRICAS_COTA[canal]["espera_s"] += espera
+        time.sleep(espera)
+
+def _status_http(resposta_ou_erro):
+    """Código HTTP de uma Response, de um APIError do gspread ou de um HTTPError do requests."""
+    resposta = getattr(resposta_ou_erro, "response", None)
+    if resposta is None and hasattr(resposta_ou_erro, "status_code"):
+        resposta = resposta_ou_erro
+    return getattr(resposta, "status_code", None), resposta
+
+def _tempo_backoff(tentativa, resposta=None):
+    retry_after = resposta.headers.get("Retry-After") if resposta is not None else None
+    if retry_after and str(retry_after).isdigit():
+        return min(float(retry_after), BACKOFF_MAXIMO)
+    # "Full jitter": sorteia entre 0 e o teto exponencial (operadores não voltam todos juntos)
+    return random.uniform(0, min(BACKOFF_MAXIMO, BACKOFF_BASE * 2 ** tentativa))
+
+def executar_com_cota(canal, funcao, idempotente=True):
+    """
+    Roda funcao() respeitando o balde do canal e tentando de novo em 429/5xx/erro de rede.
+    Uma Response com status retentável (requests.get sem raise) também conta como falha temporária.
+    idempotente=False (escritas): só repete em 429.
+    """
+    retentaveis = STATUS_RETENTAVEIS if idempotente else STATUS_RETENTAVEIS_ESCRITA
+    for tentativa in range(MAX_TENTATIVAS):
+        _aguardar_ficha(canal)
+        with _LOCK_COTA:
+            _METRICAS_COTA[canal]["chamadas"] += 1
+        ultima = tentativa == MAX_TENTATIVAS - 1
+
+        try:
+            resultado = funcao()
+        except (APIError, requests.HTTPError) as e:
+            status, resposta = _status_http(e)
+            if status not in retentaveis or ultima:
+                with _LOCK_COTA:
+                    _METRICAS_COTA[canal]["falhas"] += 1
+                raise
+        except (requests.ConnectionError, requests.Timeout):
+            status, resposta = None, None
+            if not idempotente or ultima:
+                with _LOCK_COTA:
+                    _METRICAS_COTA[canal]["falhas"] += 1
+                raise
+        else:
+            status, resposta = _status_http(resultado)
+            if status not in retentaveis or ultima:
+                return resultado
+
+        espera = _tempo_backoff(tentativa, resposta)
+        print(f"Cota Google ({canal}): status {status or 'sem resposta'}, tentando de novo em {espera:.1f}s.")
+        with _LOCK_COTA:
+            _METRICAS_COTA[canal]["retentativas"] += 1
+            _METRICAS_COTA[canal]["espera_s"] += espera
+        time.sleep(espera)
+
+def metricas_cota():
+    """Contadores por canal: chamadas, retentativas, falhas e segundos esperando (balde + backoff)."""
+    with _LOCK_COTA:
+        return {canal: dict(m) for canal, m in _METRICAS_COTA.items()}
+
+def endpoint_idempotente(endpoint):
+    """True se repetir a chamada não muda o resultado (values:batchUpdate sim, append/batchUpdate da planilha não)."""
+    caminho = str(endpoint).split("?", 1)[0]
+    if caminho.endswith(ENDPOINTS_IDEMPOTENTES):
+        return True
+    return not caminho.endswith(ENDPOINTS_NAO_IDEMPOTENTES)
+
+class ClienteHTTPComCota(HTTPClient):
+    """HTTPClient do gspread em que cada request passa pelo balde "sheets_api" (appends e batchUpdate da planilha só repetem em 429)."""
+
+    def request(self, *args, **kwargs):
+        endpoint = kwargs.get("endpoint", args[1] if len(args) > 1 else "")
+        return executar_com_cota(
+            "sheets_api",
+            lambda: HTTPClient.request(self, *args, **kwargs),
+            idempotente=endpoint_idempotente(endpoint)
+        )
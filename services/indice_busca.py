@@ -0,0 +1,211 @@
+import re
+from bisect import bisect_left, bisect_right
+from functools import reduce
+import numpy as np
+import pandas as pd
+
+# ==============================================================================
+# ÍNDICES DE BUSCA TEXTUAL
+# ==============================================================================
+# Montados uma vez por snapshot/versão dos dados e consultados a cada rerun.
+# Uma consulta devolve posições de linha (np.array ordenado) sem tocar no
+# DataFrame. A semântica é a mesma do str.contains antigo (trecho do texto
+# dentro de UMA coluna): o índice só escolhe os candidatos, a conferência
+# final é feita no texto da linha.
+
+# Separador entre colunas no texto da linha (não aparece no que o usuário digita)
+_SEP_COLUNA = "\x1f"
+_SEP_LINHA = "\n"
+
+def _texto_por_linha(df, colunas, maiusculo=True):
+    """Uma string por linha com as colunas pedidas unidas por _SEP_COLUNA."""
+    if not colunas:
+        return pd.Series("", index=df.index)
+    partes = []
+    for col in colunas:
+        texto = df[col].fillna("").astype(str).str.replace(_SEP_LINHA, " ", regex=False)
+        partes.append(texto.str.upper() if maiusculo else texto.str.lower())
+    return partes[0].str.cat(partes[1:], sep=_SEP_COLUNA) if len(partes) > 1 else partes[0]
+
+def _montar_blob(textos):
+    """Junta todas as linhas num texto só + onde cada linha começa (para str.find em C)."""
+    textos = list(textos)
+    inicios = [0]
+    for t in textos:
+        inicios.append(inicios[-1] + len(t) + 1)
+    return {"texto": _SEP_LINHA.join(textos) + _SEP_LINHA, "inicios": inicios}
+
+def _achar_no_blob(blob, termo):
+    texto, inicios = blob["texto"], blob["inicios"]
+    achados = []
+    pos = texto.find(termo)
+    while pos != -1:
+        linha = bisect_right(inicios, pos) - 1
+        achados.append(linha)
+        # Pula para a próxima linha: uma ocorrência por linha basta
+        pos = texto.find(termo, inicios[linha + 1])
+    return np.array(achados, dtype=np.int64)
+
+def _montar_postings(chaves, posicoes):
+    """
+    Pares (chave, posição da linha) -> listas de linhas por chave, guardadas
+    num array só (formato CSR): linhas[cortes[i]:cortes[i + 1]] é a lista da chave i.
+    """
+    if len(chaves) == 0:
+        return {"ids": {}, "cortes": np.zeros(1, dtype=np.int64), "linhas": np.array([], dtype=np.int64)}
+    codigos, unicas = pd.factorize(np.asarray(chaves, dtype=object), sort=False)
+    total_linhas = int(np.max(posicoes)) + 1
+    # Ordena por (chave, linha) e remove chave repetida na mesma linha
+    combinado = np.sort(codigos.astype(np.int64) * total_linhas + np.asarray(posicoes, dtype=np.int64))
+    combinado = combinado[np.concatenate(([True], np.diff(combinado) != 0))]
+    codigos_ord, linhas = np.divmod(combinado, total_linhas)
+    cortes = np.searchsorted(codigos_ord, np.arange(len(unicas) + 1))
+    return {"ids": dict(zip(unicas.tolist(), range(len(unicas)))), "cortes": cortes, "linhas": linhas}
+
+def _linhas_da_chave(postings, chave):
+    i = postings["ids"].get(chave)
+    if i is None:
+        return None
+    return postings["linhas"][postings["cortes"][i]:postings["cortes"][i + 1]]
+
+# ==============================================================================
+# GESTÃO: "BUSCAR GERAL" (TRIGRAMAS NOS CAMPOS-CHAVE + TEXTO DO RESTO)
+# ==============================================================================
+# IDs, NFs, OCs, motoristas e placas são o que mais se busca: ficam num índice
+# de trigramas (cada trecho de 3 letras -> linhas). As demais colunas vão para
+# um texto único em maiúsculo, varrido com str.find (em C, sem pandas).
+
+COLUNAS_CHAVE_GESTAO = ["ID_PROCESSO", "NF", "OC", "MOTORISTA", "VEICULO", "COD_CTE"]
+
+def _trigramas(texto):
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+def _trigramas_da_coluna(textos):
+    """Todos os trigramas de uma coluna, gerados por deslocamento (vetorizado): (trigramas, posições)."""
+    tamanhos = textos.str.len().to_numpy()
+    chaves, posicoes = [], []
+    for inicio in range(int(tamanhos.max(initial=0)) - 2):
+        validos = tamanhos >= inicio + 3
+        chaves.append(textos[validos].str.slice(inicio, inicio + 3).to_numpy(dtype=object))
+        posicoes.append(np.flatnonzero(validos))
+    if not chaves:
+        return np.array([], dtype=object), np.array([], dtype=np.int64)
+    return np.concatenate(chaves), np.concatenate(posicoes)
+
+def montar_indice_geral(df, colunas_chave=COLUNAS_CHAVE_GESTAO):
+    df = df.reset_index(drop=True)
+    nomes = {str(c).strip().upper(): c for c in df.columns}
+    chave = [nomes[c] for c in colunas_chave if c in nomes]
+    resto = [c for c in df.columns if c not in chave]
+
+    # Trigramas coluna a coluna (um trigrama nunca atravessa duas colunas)
+    pares = [_trigramas_da_coluna(_texto_por_linha(df, [c])) for c in chave]
+    trigramas = np.concatenate([t for t, _ in pares]) if pares else np.array([], dtype=object)
+    posicoes = np.concatenate([p for _, p in pares]) if pares else np.array([], dtype=np.int64)
+
+    textos_chave = _texto_por_linha(df, chave)
+    col_id = nomes.get("ID_PROCESSO")
+    ids = df[col_id].astype(str).str.strip().to_numpy() if col_id is not None else np.array([], dtype=object)
+
+    return {
+        "ids": ids,
+        "linhas_chave": textos_chave.tolist(),
+        "blob_chave": _montar_blob(textos_chave),
+        "trigramas": _montar_postings(trigramas, posicoes),
+        "blob_resto": _montar_blob(_texto_por_linha(df, resto)),
+    }
+
+def buscar_no_indice_geral(indice, termo):
+    """Posições das linhas em que 'termo' aparece em alguma coluna (sem diferenciar maiúsculas)."""
+    termo = str(termo).upper().strip()
+    if not termo:
+        return np.arange(len(indice["linhas_chave"]))
+
+    if len(termo) >= 3:
+        listas = [_linhas_da_chave(indice["trigramas"], t) for t in _trigramas(termo)]
+        if any(l is None for l in listas):
+            nas_chaves = np.array([], dtype=np.int64)
+        else:
+            # Começa pela lista mais curta; confere o termo inteiro só nos candidatos
+            candidatos = reduce(np.intersect1d, sorted(listas, key=len))
+            linhas = indice["linhas_chave"]
+            nas_chaves = np.array([p for p in candidatos if termo in linhas[p]], dtype=np.int64)
+    else:
+        nas_chaves = _achar_no_blob(indice["blob_chave"], termo)
+
+    return np.union1d(nas_chaves, _achar_no_blob(indice["blob_resto"], termo))
+
+# ==============================================================================
+# ESTOQUE: "BUSCA RÁPIDA" (ÍNDICE INVERTIDO DE TOKENS)
+# ==============================================================================
+# Cada palavra/código das colunas de busca vira um token (minúsculo) com a lista
+# de linhas onde aparece. Prefixo: busca binária no vocabulário ordenado.
+# Trecho: busca binária na lista ordenada de sufixos dos tokens ("123" acha
+# "ab1234" pelo sufixo "1234"). Vários tokens na busca = interseção.
+
+COLUNAS_BUSCA_ESTOQUE = ["DESCRICAO", "NF", "COD_ITEM", "ID_PROCESSO", "OC"]
+
+_PADRAO_TOKEN = re.compile(r"\w+")
+
+def montar_indice_tokens(df, colunas=COLUNAS_BUSCA_ESTOQUE):
+    df = df.reset_index(drop=True)
+    colunas = [c for c in colunas if c in df.columns]
+    textos = _texto_por_linha(df, colunas, maiusculo=False)
+
+    tokens = textos.str.findall(_PADRAO_TOKEN).explode().dropna()
+    postings = _montar_postings(tokens.to_numpy(dtype=object), tokens.index.to_numpy())
+
+    vocabulario = sorted(postings["ids"])
+    # Sufixos de cada token do vocabulário, ordenados, apontando para o token de origem
+    sufixos = [tok[i:] for tok in vocabulario for i in range(len(tok))]
+    origem = np.repeat(np.arange(len(vocabulario)), [len(tok) for tok in vocabulario])
+    ordem = sorted(range(len(sufixos)), key=sufixos.__getitem__)
+
+    return {
+        "linhas": textos.tolist(),
+        "postings": postings,
+        "vocabulario": vocabulario,
+        "sufixos": [sufixos[i] for i in ordem],
+        "token_do_sufixo": origem[ordem] if ordem else origem,
+    }
+
+def _faixa_ordenada(lista, prefixo):
+    return bisect_left(lista, prefixo), bisect_left(lista, prefixo + "\U0010ffff")
+
+def _tokens_que_casam(indice, parte, modo):
+    if modo == "prefixo":
+        ini, fim = _faixa_ordenada(indice["vocabulario"], parte)
+        return indice["vocabulario"][ini:fim]
+    ini, fim = _faixa_ordenada(indice["sufixos"], parte)
+    vocabulario = indice["vocabulario"]
+    return [vocabulario[i] for i in np.unique(indice["token_do_sufixo"][ini:fim])]
+
+def buscar_tokens(indice, termo, modo="trecho"):
+    """
+    Posições das linhas que contêm 'termo' em alguma das colunas indexadas.
+    modo="trecho" equivale ao str.contains; modo="prefixo" exige que cada
+    palavra da busca seja começo de uma palavra da linha.
+    """
+    termo = str(termo).lower().strip()
+    total = len(indice["linhas"])
+    if not termo:
+        return np.arange(total)
+
+    partes = _PADRAO_TOKEN.findall(termo)
+    if not partes:
+        # Só pontuação: não dá para usar o índice, confere linha a linha
+        candidatos = np.arange(total)
+    else:
+        por_parte = []
+        for parte in partes:
+            listas = [_linhas_da_chave(indice["postings"], tok) for tok in _tokens_que_casam(indice, parte, modo)]
+            if not listas:
+                return np.array([], dtype=np.int64)
+            por_parte.append(np.unique(np.concatenate(listas)))
+        candidatos = reduce(np.intersect1d, sorted(por_parte, key=len))
+        if modo == "prefixo" or (len(partes) == 1 and partes[0] == termo):
+            return candidatos.astype(np.int64)
+
+    # Busca com espaço/pontuação: confirma o trecho inteiro dentro de uma coluna
+    linhas = indice["linhas"]
+    return np.array([p for p in candidatos if any(termo in campo for campo in linhas[p].split(_SEP_COLUNA))], dtype=np.int64)
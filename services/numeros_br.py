@@ -0,0 +1,74 @@
+import pandas as pd
+
+# ==============================================================================
+# CONVERSÃO DE NÚMEROS/MOEDA EM FORMATO BRASILEIRO (VETORIZADA)
+# ==============================================================================
+# Um único parser para todas as páginas. Regras:
+#   - Números de verdade (int/float) passam direto.
+#   - Texto: tira "R$", espaços e qualquer coisa que não seja dígito, vírgula,
+#     ponto ou sinal de menos.
+#   - Tem vírgula e ponto: o que aparece por último é o separador decimal
+#     ("1.000,50" -> 1000.5 | "1,000.50" -> 1000.5).
+#   - Só vírgula: uma vírgula é decimal ("12,5"); várias são milhar ("1,000,000").
+#   - Só ponto: vários pontos são milhar ("1.000.000"); um ponto seguido de
+#     exatamente 3 dígitos também é milhar ("1.234" -> 1234), exceto "0.xxx";
+#     nos demais casos é decimal ("1000.5").
+#   - Vazio vale 0 e não conta como falha. Lixo sem número vale 0 e conta como falha.
+
+_PADRAO_MILHAR_PONTO = r'^-?[1-9]\d{0,2}\.\d{3}$'
+
+def converter_numeros_br(serie, centavos=False):
+    """
+    Converte uma coluna inteira de valores BR ('R$ 1.000,50', '1000.5', '', lixo).
+    Retorna (valores, falhas):
+      - valores: float64 (ou Int64 em centavos, se centavos=True), 0 onde não deu
+      - falhas: Series booleana, True nas linhas que tinham conteúdo mas não viraram número
+    """
+    serie = pd.Series(serie)
+    if pd.api.types.is_numeric_dtype(serie) and not pd.api.types.is_bool_dtype(serie):
+        valores = serie.astype(float)
+        falhas = pd.Series(False, index=serie.index)
+        return _finalizar(valores.fillna(0.0), falhas, centavos)
+
+    # Coluna object pode misturar números (float do CSV) com texto ("" do fillna)
+    eh_texto = serie.map(type).eq(str) if pd.api.types.is_object_dtype(serie) else serie.notna()
+    numeros = pd.to_numeric(serie.where(~eh_texto), errors='coerce')
+
+    texto = serie.where(eh_texto, "").astype(str).str.strip()
+    vazio = texto.eq("") | texto.str.lower().isin(["nan", "none", "nat"])
+
+    limpo = texto.str.replace(r'R\$', '', regex=True).str.replace(r'[^\d,.\-]', '', regex=True)
+
+    tem_virgula = limpo.str.contains(',', regex=False)
+    tem_ponto = limpo.str.contains('.', regex=False)
+    virgula_por_ultimo = limpo.str.rfind(',') > limpo.str.rfind('.')
+
+    # Casos em que o ponto é separador de milhar (some) e a vírgula vira ponto decimal
+    ponto_e_milhar = (
+        (tem_virgula & tem_ponto & virgula_por_ultimo)
+        | (~tem_virgula & (limpo.str.count(r'\.') > 1))
+        | (~tem_virgula & limpo.str.match(_PADRAO_MILHAR_PONTO))
+    )
+    # Casos em que a vírgula é separador de milhar (some)
+    virgula_e_milhar = (tem_virgula & tem_ponto & ~virgula_por_ultimo) | (~tem_ponto & (limpo.str.count(',') > 1))
+
+    normalizado = limpo.mask(ponto_e_milhar, limpo.str.replace('.', '', regex=False))
+    normalizado = normalizado.mask(virgula_e_milhar, normalizado.str.replace(',', '', regex=False))
+    normalizado = normalizado.str.replace(',', '.', regex=False)
+
+    convertidos = pd.to_numeric(normalizado.where(eh_texto & ~vazio), errors='coerce')
+    valores = numeros.fillna(convertidos).astype(float)
+
+    falhas = eh_texto & ~vazio & convertidos.isna()
+    return _finalizar(valores.fillna(0.0), falhas, centavos)
+
+def _finalizar(valores, falhas, centavos):
+    if centavos:
+        valores = (valores * 100).round().astype("Int64")
+    return valores, falhas
+
+def formatar_moeda_br(valores):
+    """Coluna de números (ou texto BR) -> 'R$ 1.000,00'."""
+    numeros, _ = converter_numeros_br(valores)
+    texto = numeros.map("R$ {:,.2f}".format)
+    return texto.str.replace(",", "X", regex=False).str.replace(".", ",", regex=False).str.replace("X", ".", regex=False)
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+# ==============================================================================
+# MOTOR DE PRAZOS / SLA (VETORIZADO)
+# ==============================================================================
+# Calcula de uma vez, para a coluna inteira, quantos dias cada processo está
+# aberto e em que faixa de prazo ele cai. Dashboard (KPIs e Kanban), Gestão
+# (badge do expander) e Processo_Devolucao (coluna PRAZO) leem daqui.
+
+FUSO_BR = ZoneInfo('America/Sao_Paulo')
+
+COR_SEM_DATA = "grey"
+
+# (limite de dias exclusivo, faixa, cor) - a última faixa pega o resto
+FAIXAS_PRAZO = [
+    (3, "FRESCO", "#00B17C"),
+    (5, "ATENÇÃO", "#5173C2"),
+    (10, "PRAZO 10", "#EC9E55"),
+    (20, "PRAZO 20", "#E9EB7B"),
+]
+FAIXA_ESTOUROU = ("ESTOUROU", "#FF4B4B")
+
+def hoje_br():
+    return datetime.now(FUSO_BR).date()
+
+def _texto_vazio(serie):
+    texto = serie.astype(str).str.strip()
+    return serie.isna() | texto.isin(["", "None", "nan", "NaT"])
+
+def converter_datas_br(serie):
+    """Coluna de datas BR ('25/12/2024', '25/12/2024 14:30', ISO...) -> datetime64. Inválidas viram NaT."""
+    serie = pd.Series(serie)
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return serie.dt.tz_localize(None) if serie.dt.tz is not None else serie
+    return pd.to_datetime(serie.where(~_texto_vazio(serie)), format='mixed', dayfirst=True, errors='coerce')
+
+def classificar_prazos(datas_inicio, datas_fim=None, hoje=None):
+    """
+    Classifica uma coluna inteira de datas de início.
+    - datas_fim: opcional; onde tiver data válida, a contagem para nela (processo finalizado).
+      Onde estiver vazia, conta até hoje.
+    - hoje: date de referência (padrão: hoje no fuso de Brasília).
+
+    Retorna um DataFrame com o mesmo índice e as colunas:
+      DIAS (Int64, <NA> sem data), FAIXA, COR, ROTULO ('PRAZO 10 (7 dias)') e TEMPO ('Hoje', 'Ontem', 'há 7d').
+    """
+    inicio_bruto = pd.Series(datas_inicio)
+    inicio = converter_datas_br(inicio_bruto).dt.normalize()
+
+    referencia = pd.Timestamp(hoje or hoje_br())
+    fim = pd.Series(referencia, index=inicio.index)
+    if datas_fim is not None:
+        fim_convertido = converter_datas_br(pd.Series(datas_fim, index=inicio.index)).dt.normalize()
+        fim = fim_convertido.where(fim_convertido.notna(), referencia)
+
+    dias = (fim - inicio).dt.days
+
+    sem_data = _texto_vazio(inicio_bruto) if not pd.api.types.is_datetime64_any_dtype(inicio_bruto) else inicio.isna()
+    invalida = inicio.isna() & ~sem_data
+
+    condicoes = [sem_data.to_numpy(), invalida.to_numpy()] + [(dias < limite).to_numpy() for limite, _, _ in FAIXAS_PRAZO]
+    faixa = np.select(condicoes, ["SEM DATA", "DATA INVÁLIDA"] + [nome for _, nome, _ in FAIXAS_PRAZO], default=FAIXA_ESTOUROU[0])
+    cor = np.select(condicoes, [COR_SEM_DATA, COR_SEM_DATA] + [c for _, _, c in FAIXAS_PRAZO], default=FAIXA_ESTOUROU[1])
+
+    dias_txt = dias.astype("Int64").astype(str)
+    rotulo = np.where(
+        inicio.isna().to_numpy(),
+        faixa,
+        (pd.Series(faixa, index=inicio.index) + " (" + dias_txt + " dias)").to_numpy()
+    )
+    tempo = np.select(
+        [inicio.isna().to_numpy(), (dias <= 0).to_numpy(), (dias == 1).to_numpy()],
+        ["—", "Hoje", "Ontem"],
+        default=("há " + dias_txt + "d").to_numpy()
+    )
+
+    return pd.DataFrame({
+        "DIAS": dias.astype("Int64"),
+        "FAIXA": faixa,
+        "COR": cor,
+        "ROTULO": rotulo,
+        "TEMPO": tempo,
+    }, index=inicio.index)
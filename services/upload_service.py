@@ -3,6 +3,20 @@ import cloudinary.uploader
 import streamlit as st
 import os
 import re 
+import json
+import hashlib
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from io import BytesIO
+from pathlib import Path
+from PIL import Image, ImageOps
+
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:  # Sem pypdf o PDF sobe como veio
+    PdfReader = PdfWriter = None
 
 # CHAVE
 # =========================================================
@@ -15,6 +29,26 @@ cloudinary.config(
 )
 # ==========================================================
 
+# Uploads simultâneos no pool (cada um é só espera de rede)
+MAX_UPLOADS_PARALELOS = 4
+
+# Quantos uploads recentes ficam nas métricas
+HISTORICO_METRICAS_UPLOAD = 200
+
+# Compactação antes do upload (fotos de celular chegam com vários MB)
+COMPACTAR_ANEXOS = True
+LADO_MAXIMO_IMAGEM = 2000      # px no maior lado
+QUALIDADE_JPEG = 80
+QUALIDADE_MINIMA_JPEG = 50
+ORCAMENTO_BYTES = 1_000_000    # alvo por arquivo (imagens descem a qualidade até caber)
+
+# Registro hash do conteúdo -> link (mesma pasta de cache local dos snapshots)
+ARQUIVO_REGISTRO_UPLOADS = Path(".cache") / "uploads" / "links_por_hash.json"
+
+_POOL_UPLOADS = ThreadPoolExecutor(max_workers=MAX_UPLOADS_PARALELOS, thread_name_prefix="upload-cloudinary")
+_METRICAS_UPLOAD = deque(maxlen=HISTORICO_METRICAS_UPLOAD)
+_LOCK_METRICAS_UPLOAD = threading.Lock()
+
 def sanitizar_nome_arquivo(nome):
     """
     Remove caracteres inválidos do nome do arquivo para o Cloudinary.
@@ -32,13 +66,132 @@ def sanitizar_nome_arquivo(nome):
     # Recoloca extensão
     return nome_limpo + extensao
 
-def upload_bytes_cloudinary(dados_bytes, nome_arquivo):
+# =========================================================
+# COMPACTAÇÃO ANTES DO UPLOAD
+# =========================================================
+# Imagem: corrige a rotação do EXIF, reduz para LADO_MAXIMO_IMAGEM no maior lado,
+# descarta metadados (EXIF/GPS) e regrava em JPEG; se passar do orçamento, a
+# qualidade desce até QUALIDADE_MINIMA_JPEG e, por último, a resolução.
+# Imagem com transparência continua PNG (otimizado).
+# PDF: só recompressão sem perda (streams de conteúdo + objetos repetidos) e sem
+# metadados; o orçamento não se aplica (as imagens escaneadas ficam intactas).
+# Se o resultado não ficar menor, o original é enviado.
+
+def _salvar_jpeg(img, qualidade):
+    saida = BytesIO()
+    img.save(saida, "JPEG", quality=qualidade, optimize=True, progressive=True)
+    return saida.getvalue()
+
+def _compactar_imagem(dados_bytes, orcamento_bytes):
+    with Image.open(BytesIO(dados_bytes)) as original:
+        img = ImageOps.exif_transpose(original)
+        img.thumbnail((LADO_MAXIMO_IMAGEM, LADO_MAXIMO_IMAGEM))
+
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            saida = BytesIO()
+            img.save(saida, "PNG", optimize=True)
+            return saida.getvalue(), ".png"
+
+        img = img.convert("RGB")
+        for qualidade in range(QUALIDADE_JPEG, QUALIDADE_MINIMA_JPEG - 1, -10):
+            compactado = _salvar_jpeg(img, qualidade)
+            if len(compactado) <= orcamento_bytes:
+                return compactado, ".jpg"
+
+        # Nem na qualidade mínima coube: reduz a resolução na proporção que falta
+        escala = (orcamento_bytes / len(compactado)) ** 0.5
+        img = img.resize((max(1, int(img.width * escala)), max(1, int(img.height * escala))), Image.LANCZOS)
+        return _salvar_jpeg(img, QUALIDADE_MINIMA_JPEG), ".jpg"
+
+def _compactar_pdf(dados_bytes):
+    if PdfWriter is None:
+        return dados_bytes
+    escritor = PdfWriter(clone_from=PdfReader(BytesIO(dados_bytes)))
+    for pagina in escritor.pages:
+        pagina.compress_content_streams()
+    escritor.compress_identical_objects()
+    escritor.metadata = None
+    saida = BytesIO()
+    escritor.write(saida)
+    return saida.getvalue()
+
+def compactar_anexo(dados_bytes, nome_arquivo, orcamento_bytes=ORCAMENTO_BYTES):
+    """
+    Compacta imagem/PDF antes do upload. Retorna (bytes, nome_arquivo); o nome
+    muda de extensão quando a imagem é regravada em outro formato.
+    Qualquer erro (arquivo corrompido, formato desconhecido) devolve o original.
+    """
+    nome_base, extensao = os.path.splitext(nome_arquivo)
+    try:
+        if extensao.lower() == ".pdf" or dados_bytes[:4] == b"%PDF":
+            compactado, nova_extensao = _compactar_pdf(dados_bytes), extensao
+        else:
+            compactado, nova_extensao = _compactar_imagem(dados_bytes, orcamento_bytes)
+            # Sem extensão no nome (ex.: NFD_<nf>_<uuid>) continua sem
+            nova_extensao = nova_extensao if extensao else ""
+    except Exception as e:
+        print(f"⚠️ Compactação ignorada ({nome_arquivo}): {e}")
+        return dados_bytes, nome_arquivo
+
+    if len(compactado) >= len(dados_bytes):
+        return dados_bytes, nome_arquivo
+    return compactado, nome_base + nova_extensao
+
+# =========================================================
+# DEDUPLICAÇÃO POR CONTEÚDO
+# =========================================================
+# O mesmo PDF costuma ser anexado várias vezes (criação, CTE/COB, chat). O
+# sha256 dos bytes originais (antes da compactação) é a chave de um registro
+# hash -> link, gravado em disco a cada upload novo. Arquivo repetido devolve o
+# link existente na hora, sem compactar nem tocar a rede. O public_id leva o
+# começo do hash e não há overwrite: um link registrado nunca muda de conteúdo.
+
+_REGISTRO_UPLOADS = {"links": {}, "carregado": False}
+_LOCK_REGISTRO_UPLOADS = threading.Lock()
+
+def hash_conteudo(dados_bytes):
+    return hashlib.sha256(dados_bytes).hexdigest()
+
+def _links_por_hash():
+    """Registro em memória, carregado do disco na primeira vez (chamar com o lock)."""
+    if not _REGISTRO_UPLOADS["carregado"]:
+        _REGISTRO_UPLOADS["carregado"] = True
+        try:
+            if ARQUIVO_REGISTRO_UPLOADS.exists():
+                _REGISTRO_UPLOADS["links"] = json.loads(ARQUIVO_REGISTRO_UPLOADS.read_text(encoding="utf-8"))
+        except Exception as e:
+            print(f"Aviso: registro de uploads ilegível, começando vazio: {e}")
+    return _REGISTRO_UPLOADS["links"]
+
+def link_ja_enviado(dados_bytes, hash_dados=None):
+    """Link de um upload anterior com exatamente os mesmos bytes, ou "" se não houver."""
+    with _LOCK_REGISTRO_UPLOADS:
+        return _links_por_hash().get(hash_dados or hash_conteudo(dados_bytes), "")
+
+def _registrar_link(hash_dados, link):
+    """Guarda hash -> link e grava o registro em disco (.tmp + rename)."""
+    with _LOCK_REGISTRO_UPLOADS:
+        links = _links_por_hash()
+        links[hash_dados] = link
+        try:
+            ARQUIVO_REGISTRO_UPLOADS.parent.mkdir(parents=True, exist_ok=True)
+            tmp = ARQUIVO_REGISTRO_UPLOADS.with_suffix(".json.tmp")
+            tmp.write_text(json.dumps(links), encoding="utf-8")
+            os.replace(tmp, ARQUIVO_REGISTRO_UPLOADS)
+        except Exception as e:
+            print(f"Aviso: não foi possível salvar o registro de uploads em disco: {e}")
+
+def upload_bytes_cloudinary(dados_bytes, nome_arquivo, compactar=COMPACTAR_ANEXOS):
     """
     Faz upload de bytes (arquivo) para o Cloudinary.
-    Suporta PDFs e Imagens.
+    Suporta PDFs e Imagens. Com compactar=True, passa antes por compactar_anexo.
+    Se os mesmos bytes já foram enviados, devolve o link anterior sem upload.
     """
+    inicio = time.perf_counter()
+    tamanho_original = tamanho = len(dados_bytes or b"")
+    link = ""
+    reaproveitado = False
     try:
-        tamanho = len(dados_bytes)
         print(f"\n--- 🕵️ DEBUG UPLOAD ---")
         print(f"📂 Nome Original: {nome_arquivo}")
         
@@ -46,8 +199,23 @@ def upload_bytes_cloudinary(dados_bytes, nome_arquivo):
             print("❌ ERRO: Bytes vazios.")
             return ""
 
+        hash_dados = hash_conteudo(dados_bytes)
+        link = link_ja_enviado(dados_bytes, hash_dados)
+        if link:
+            reaproveitado, tamanho = True, 0
+            print(f"♻️ Arquivo já enviado antes: {link}\n")
+            return link
+
+        if compactar:
+            dados_bytes, nome_arquivo = compactar_anexo(dados_bytes, nome_arquivo)
+            tamanho = len(dados_bytes)
+            print(f"🗜️ Compactação: {tamanho_original} -> {tamanho} bytes")
+
         # ✅ SANITIZA O NOME (Remove caracteres inválidos)
-        nome_limpo = sanitizar_nome_arquivo(nome_arquivo)
+        # + trecho do hash: arquivo diferente com o mesmo nome vira outro public_id,
+        # então um link do registro nunca passa a apontar para outro documento
+        nome_base, extensao = os.path.splitext(sanitizar_nome_arquivo(nome_arquivo))
+        nome_limpo = f"{nome_base}_{hash_dados[:16]}{extensao}"
         print(f"✅ Nome Sanitizado: {nome_limpo}")
         print(f"📊 Tamanho: {tamanho} bytes")
 
@@ -69,13 +237,79 @@ def upload_bytes_cloudinary(dados_bytes, nome_arquivo):
             resource_type=tipo_recurso,
             type="upload",
             access_mode="public",  # Garante acesso público
-            overwrite=True  # Sobrescreve se já existir
+            overwrite=False  # Mesmo public_id = mesmo conteúdo: reaproveita o que já está lá
         )
         
         link = resposta['secure_url']
+        _registrar_link(hash_dados, link)
         print(f"✅ SUCESSO: {link}\n")
         return link
 
     except Exception as e:
         print(f"❌ ERRO CLOUDINARY: {e}\n")
-        return ""
\ No newline at end of file
+        return ""
+    finally:
+        _registrar_metrica(nome_arquivo, tamanho_original, tamanho, time.perf_counter() - inicio, bool(link), reaproveitado)
+
+# =========================================================
+# UPLOADS EM PARALELO (NÃO BLOQUEANTES)
+# =========================================================
+# upload_async devolve um Future na hora; o upload roda no pool. Vários anexos
+# do mesmo salvamento sobem juntos, e o tempo total é o do mais lento.
+# O Future sempre resolve para o link ("" se falhou), como upload_bytes_cloudinary.
+
+def _registrar_metrica(nome_arquivo, tamanho_original, tamanho, segundos, ok, reaproveitado=False):
+    with _LOCK_METRICAS_UPLOAD:
+        _METRICAS_UPLOAD.append({
+            "arquivo": nome_arquivo, "bytes_original": tamanho_original, "bytes": tamanho,
+            "segundos": round(segundos, 3), "ok": ok, "reaproveitado": reaproveitado, "ts": time.time()
+        })
+    print(f"⏱️ Upload {nome_arquivo}: {tamanho_original / 1024:.0f} -> {tamanho / 1024:.0f} KB em {segundos:.2f}s ({'ok' if ok else 'falhou'})")
+
+# Uploads em andamento por hash: o mesmo arquivo anexado duas vezes no mesmo
+# salvamento (CTE e COB iguais) sobe uma vez só e os dois recebem o mesmo Future
+_EM_ANDAMENTO = {}
+
+def upload_async(dados_bytes, nome_arquivo):
+    """Agenda o upload e retorna um Future com o link (já resolvido se o arquivo é repetido)."""
+    if not dados_bytes:
+        return _POOL_UPLOADS.submit(upload_bytes_cloudinary, dados_bytes, nome_arquivo)
+
+    inicio = time.perf_counter()
+    hash_dados = hash_conteudo(dados_bytes)
+    link = link_ja_enviado(dados_bytes, hash_dados)
+    if link:
+        _registrar_metrica(nome_arquivo, len(dados_bytes), 0, time.perf_counter() - inicio, True, reaproveitado=True)
+        pronto = Future()
+        pronto.set_result(link)
+        return pronto
+
+    with _LOCK_REGISTRO_UPLOADS:
+        futuro = _EM_ANDAMENTO.get(hash_dados)
+        if futuro is None:
+            futuro = _POOL_UPLOADS.submit(upload_bytes_cloudinary, dados_bytes, nome_arquivo)
+            _EM_ANDAMENTO[hash_dados] = futuro
+            futuro.add_done_callback(lambda _: _EM_ANDAMENTO.pop(hash_dados, None))
+        else:
+            # Pega carona no upload que já está subindo: conta como reaproveitado quando terminar
+            futuro.add_done_callback(lambda f: _registrar_metrica(
+                nome_arquivo, len(dados_bytes), 0, time.perf_counter() - inicio, bool(f.result()), reaproveitado=True
+            ))
+    return futuro
+
+def upload_varios(arquivos):
+    """
+    arquivos: {chave: (bytes, nome_arquivo)} -> {chave: Future}.
+    Todos começam ao mesmo tempo.
+    """
+    return {chave: upload_async(dados, nome) for chave, (dados, nome) in arquivos.items()}
+
+def aguardar_links(futuros, timeout=None):
+    """{chave: Future} -> {chave: link}. O que não terminou no timeout fica como ""."""
+    wait(list(futuros.values()), timeout=timeout)
+    return {chave: (f.result() if f.done() else "") for chave, f in futuros.items()}
+
+def metricas_upload():
+    """Uploads recentes: arquivo, bytes_original, bytes (enviados), segundos, ok, reaproveitado e ts (mais antigo primeiro)."""
+    with _LOCK_METRICAS_UPLOAD:
+        return list(_METRICAS_UPLOAD)
\ No newline at end of file